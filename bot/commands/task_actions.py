@@ -3,6 +3,7 @@ from __future__ import annotations
 
 import asyncio
 import logging
+from functools import lru_cache, partial
 from typing import Any, Optional
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
@@ -20,13 +21,15 @@ logger = logging.getLogger(__name__)
 
 async def _run_blocking(func, *args, **kwargs):
     loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, lambda: func(*args, **kwargs))
+    return await loop.run_in_executor(None, partial(func, *args, **kwargs))
 
 
+@lru_cache(maxsize=1024)
 def build_task_actions_kb(task_id: int) -> InlineKeyboardMarkup:
     """
     Кнопки для просроченной/актуальной задачи.
     callback_data формат: task_action:<task_id>:<action>
+    Разметка зависит только от task_id, а объекты PTB 20 неизменяемы — кэшируем по id.
     """
     return InlineKeyboardMarkup([
         [
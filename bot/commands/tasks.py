@@ -3,6 +3,7 @@ from __future__ import annotations
 import logging
 import asyncio
 import re
+from functools import partial
 from typing import Optional, Any, List
 from datetime import datetime
 from zoneinfo import ZoneInfo
@@ -25,7 +26,7 @@ logger = logging.getLogger(__name__)
 async def _run_blocking(func, *args, **kwargs):
     """Run sync function in executor to avoid blocking PTB event loop."""
     loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, lambda: func(*args, **kwargs))
+    return await loop.run_in_executor(None, partial(func, *args, **kwargs))
 
 
 def _fmt_epoch(due_at: Optional[int]) -> str:
@@ -3,6 +3,7 @@ from __future__ import annotations
 
 import logging
 import asyncio
+from functools import partial
 from typing import List, Dict, Any, Optional
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
@@ -19,7 +20,7 @@ logger = logging.getLogger(__name__)
 async def _run_blocking(func, *args, **kwargs):
     """Запуск синхронной функции в thread pool (как в tasks.py)."""
     loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, lambda: func(*args, **kwargs))
+    return await loop.run_in_executor(None, partial(func, *args, **kwargs))
 
 
 def _fmt_date(epoch: int) -> str:
@@ -7,18 +7,49 @@ from __future__ import annotations
 Использование:
 - encrypt_dict / decrypt_dict — для JSON-словарей (token_json в oauth_tokens)
 - encrypt_text / decrypt_text — для произвольных строк (на будущее)
+
+Новые записи шифруются AES-256-GCM (одна AEAD-операция OpenSSL вместо AES-CBC + HMAC у Fernet)
+и хранятся как "g1:" + base64url(nonce || ciphertext). Старые Fernet-токены и plaintext JSON
+по-прежнему читаются.
 """
 
+import base64
 import json
 import logging
 import os
 from typing import Any, Dict
 
+from cryptography.exceptions import InvalidTag
 from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+try:  # orjson работает с bytes напрямую: без encode/decode вокруг Fernet и в 3-10 раз быстрее json
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
+
+if orjson is not None:
+    def _dumps_bytes(data: Dict[str, Any]) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+    _loads = orjson.loads
+else:
+    def _dumps_bytes(data: Dict[str, Any]) -> bytes:
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    _loads = json.loads
+
 _FERNET: Fernet | None = None
+# AESGCM держит готовое расписание ключей — создаётся один раз вместе с _FERNET
+_AESGCM: AESGCM | None = None
+
+_GCM_PREFIX = "g1:"
+_GCM_NONCE_SIZE = 12
 
 
 def _get_fernet() -> Fernet:
@@ -29,7 +60,7 @@ def _get_fernet() -> Fernet:
       - ENCRYPTION_KEY должен быть результатом Fernet.generate_key().decode(),
         то есть base64-строка длиной 44 символа.
     """
-    global _FERNET
+    global _FERNET, _AESGCM
     if _FERNET is not None:
         return _FERNET
 
@@ -52,18 +83,47 @@ def _get_fernet() -> Fernet:
         logger.exception("Не удалось инициализировать Fernet. Проверь ENCRYPTION_KEY в .env")
         raise RuntimeError("ENCRYPTION_KEY некорректен, не удалось инициализировать Fernet")
 
+    # Ключ AES-GCM выводим из того же ENCRYPTION_KEY (HKDF), чтобы не требовать вторую переменную
+    aead_key = HKDF(
+        algorithm=hashes.SHA256(), length=32, salt=None, info=b"ai-assistant/secure_tokens/aes-gcm",
+    ).derive(base64.urlsafe_b64decode(key))
+    _AESGCM = AESGCM(aead_key)
+
     return _FERNET
 
 
+def _get_aesgcm() -> AESGCM:
+    if _FERNET is None or _AESGCM is None:
+        _get_fernet()
+    return _AESGCM
+
+
+def _encrypt_bytes(data: bytes) -> str:
+    nonce = os.urandom(_GCM_NONCE_SIZE)
+    blob = nonce + _get_aesgcm().encrypt(nonce, data, None)
+    return _GCM_PREFIX + base64.urlsafe_b64encode(blob).decode("ascii")
+
+
+def _decrypt_bytes(token: str) -> bytes:
+    """
+    "g1:..." — AES-GCM, иначе — Fernet-токен (записи до перехода на GCM).
+    Ошибка аутентификации в обоих случаях — InvalidToken.
+    """
+    if token.startswith(_GCM_PREFIX):
+        try:
+            raw = base64.urlsafe_b64decode(token[len(_GCM_PREFIX):])
+            return _get_aesgcm().decrypt(raw[:_GCM_NONCE_SIZE], raw[_GCM_NONCE_SIZE:], None)
+        except (InvalidTag, ValueError) as e:
+            raise InvalidToken from e
+    return _get_fernet().decrypt(token.encode("utf-8"))
+
+
 def encrypt_dict(data: Dict[str, Any]) -> str:
     """
-    Сериализует dict -> JSON -> шифрует через Fernet -> str (base64).
+    Сериализует dict -> JSON -> шифрует AES-GCM -> str ("g1:" + base64).
     Используем для token_json в oauth_tokens.
     """
-    f = _get_fernet()
-    blob = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
-    token = f.encrypt(blob)
-    return token.decode("utf-8")
+    return _encrypt_bytes(_dumps_bytes(data))
 
 
 def decrypt_dict(blob: str) -> Dict[str, Any]:
@@ -71,22 +131,18 @@ def decrypt_dict(blob: str) -> Dict[str, Any]:
     Расшифровывает str (как из БД) -> dict.
 
     Backward-compatible логика:
-      1) Пробуем как Fernet-шифротекст
+      1) Пробуем как шифротекст (AES-GCM или старый Fernet)
       2) Если InvalidToken — пробуем воспринять как старый plaintext JSON
     """
     if not blob:
         return {}
 
-    f = _get_fernet()
-
     try:
-        # Пытаемся расшифровать как Fernet-токен
-        decrypted = f.decrypt(blob.encode("utf-8"))
-        return json.loads(decrypted.decode("utf-8"))
+        return _loads(_decrypt_bytes(blob))
     except InvalidToken:
         # Скорее всего, это старый JSON без шифрования
         try:
-            return json.loads(blob)
+            return _loads(blob)
         except Exception:
             logger.exception(
                 "decrypt_dict: строка не расшифровывается и не парсится как JSON. blob (обрезан): %r",
@@ -103,10 +159,8 @@ def encrypt_text(text: str) -> str:
     Шифрование произвольной текстовой строки.
     На будущее — если захочешь шифровать ещё что-то (не только JSON).
     """
-    f = _get_fernet()
-    return f.encrypt(text.encode("utf-8")).decode("utf-8")
+    return _encrypt_bytes(text.encode("utf-8"))
 
 
 def decrypt_text(token: str) -> str:
-    f = _get_fernet()
-    return f.decrypt(token.encode("utf-8")).decode("utf-8")
+    return _decrypt_bytes(token).decode("utf-8")
@@ -5,6 +5,7 @@ import asyncio
 import logging
 import uuid
 from datetime import datetime, timedelta
+from functools import partial
 from typing import Dict, Tuple, Optional
 
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton, Update
@@ -54,7 +55,7 @@ async def offer_capture(source, context: Optional[ContextTypes.DEFAULT_TYPE] = N
 
 async def _run_blocking(func, *args, **kwargs):
     loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, lambda: func(*args, **kwargs))
+    return await loop.run_in_executor(None, partial(func, *args, **kwargs))
 
 async def handle_capture_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
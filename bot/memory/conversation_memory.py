@@ -51,6 +51,21 @@ class ConversationMemoryManager:
             meta_json=meta,
         )
 
+    def add_messages(
+        self,
+        user_id: int,
+        messages: List[Dict[str, Any]],
+    ) -> List[int]:
+        """
+        Сохраняет пачку сообщений одной транзакцией (один коммит вместо коммита на сообщение).
+        messages: [{"role": "...", "content": "...", "meta": {...}?}, ...] в хронологическом порядке.
+        Возвращает id вставленных записей в том же порядке.
+        """
+        return self.db.add_conversation_messages_bulk([
+            {"user_id": user_id, "role": m["role"], "content": m["content"], "meta_json": m.get("meta")}
+            for m in messages
+        ])
+
     def get_recent_messages(self, user_id: int, limit: int = 10) -> List[ConversationMessage]:
         """
         Возвращает последние limit сообщений по ts_epoch (по возрастанию).
@@ -1,6 +1,7 @@
 # bot/memory/memory_loader.py
 from __future__ import annotations
 import os
+import atexit
 import logging
 import asyncio
 from typing import Optional, Dict, Any, List
@@ -28,6 +29,8 @@ class _SQLiteAdapter(MemoryBackend):
     def __init__(self) -> None:
         # Единая БД для бота и setup-скрипта
         self._sqlite = MemorySQLite(DB_PATH)
+        # Соединения живут весь процесс; закрываем при выходе — последнее закрытие делает checkpoint WAL
+        atexit.register(self._sqlite.close)
         self._calendar_sync = CalendarSync(self._sqlite)  # 👈 инициализация календарного синка
         logger.info("SQLiteAdapter initialized (DB path: %s)", self._sqlite.db_path)
 
@@ -46,17 +49,18 @@ class _SQLiteAdapter(MemoryBackend):
         due_at: Optional[int] = None,
         extra: Optional[dict] = None
     ) -> int:
-        task_id = self._sqlite.add_task(
+        # RETURNING: задача для календаря приходит из того же INSERT, без get_task
+        task = self._sqlite.add_task_returning(
             user_id=user_id or 0,
             text=text,
             raw_text=raw_text,
             due_at=due_at,
             extra=extra,
         )
+        task_id = task.id
 
         # --- PUSH → Google ---
         try:
-            task = self._sqlite.get_task(task_id)
             asyncio.create_task(self._calendar_sync.on_task_created(user_id or 0, task))
         except Exception as e:
             logger.warning(f"[MemoryLoader] Failed to push new task to calendar: {e}")
@@ -64,10 +68,10 @@ class _SQLiteAdapter(MemoryBackend):
         return task_id
 
     def update_task(self, task_id: int, **fields) -> bool:
-        ok = self._sqlite.update_task(task_id, **fields)
+        task = self._sqlite.update_task_returning(task_id, **fields)
+        ok = task is not None
         if ok:
             try:
-                task = self._sqlite.get_task(task_id)
                 user_id = getattr(task, "user_id", 0)
                 asyncio.create_task(self._calendar_sync.on_task_updated(user_id, task))
             except Exception as e:
@@ -88,6 +92,9 @@ class _SQLiteAdapter(MemoryBackend):
     def get_task(self, task_id: int):
         return self._sqlite.get_task(task_id)
 
+    def get_tasks_by_ids(self, ids):
+        return self._sqlite.get_tasks_by_ids(ids)
+
     def list_tasks(
         self,
         user_id: Optional[int] = None,
@@ -97,6 +104,20 @@ class _SQLiteAdapter(MemoryBackend):
     ):
         return self._sqlite.list_tasks(user_id=user_id, status=status, limit=limit, offset=offset)
 
+    def list_upcoming_tasks(
+        self,
+        *,
+        user_id: Optional[int] = None,
+        due_from: Optional[int] = None,
+        due_to: Optional[int] = None,
+        status: str = "open",
+        limit: Optional[int] = None,
+    ):
+        # Брифинги/дайджесты и /today, /week: диапазон due_at по индексу (user_id, status, due_at)
+        return self._sqlite.list_upcoming_tasks(
+            user_id=user_id, due_from=due_from, due_to=due_to, status=status, limit=limit
+        )
+
     def update_task_status(self, task_id: int, status: str) -> bool:
         return self._sqlite.update_task(task_id, status=status)
 
@@ -171,6 +192,11 @@ class _SQLiteAdapter(MemoryBackend):
     def mark_task_locally_modified(self, task_id: int) -> bool:
         return self._sqlite.mark_task_locally_modified(task_id)
 
+    # --------- Обслуживание БД ---------
+
+    def maintenance_tick(self) -> None:
+        self._sqlite.maintenance_tick()
+
 
 def get_memory(backend: Optional[str] = None) -> MemoryBackend:
     """
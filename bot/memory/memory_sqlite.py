@@ -12,24 +12,162 @@ Production-ready SQLite storage (только логику БД).
 
 from __future__ import annotations
 
+import logging
+import os
+import queue
+import re
 import sqlite3
+import threading
 import time
+import copy
 import json
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Union, Tuple
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Union, Tuple
 from contextlib import contextmanager
+from functools import lru_cache
 from bot.core.secure_tokens import encrypt_dict, decrypt_dict
 
+logger = logging.getLogger(__name__)
+
+try:  # orjson (C) в 3-10 раз быстрее stdlib json на dumps/loads; stdlib — запасной вариант
+    import orjson
+except ImportError:
+    orjson = None
+
 Epoch = int
-# ↑ Увеличиваем версию схемы: 5 (ранее было 4)
-SCHEMA_VERSION = 5
+# ↑ Увеличиваем версию схемы: 15 (ранее было 14)
+SCHEMA_VERSION = 15
+
+# tasks.id — с AUTOINCREMENT: id удалённой задачи никогда не выдаётся повторно. Приложение на это
+# опирается: id зашит в callback_data кнопок (task_action:<id>:<action>) и в id джобов напоминаний
+# (reminder:<user>:<id>) — переиспользованный id привёл бы старую карточку/напоминание к чужой задаче.
+_TASKS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS {name} (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    raw_text TEXT,
+    status TEXT NOT NULL DEFAULT 'open' CHECK (status IN ('open','done','archived')),
+    due_at INTEGER,
+    created_at INTEGER NOT NULL,
+    updated_at INTEGER NOT NULL,
+    source TEXT,
+    source_agent TEXT,
+    extra TEXT,
+    calendar_id TEXT,
+    calendar_event_id TEXT,
+    calendar_event_etag TEXT,
+    google_updated_at INTEGER,
+    recurrence TEXT,
+    person_id INTEGER,
+    notes TEXT,
+    last_modified INTEGER
+);
+"""
+
+# Per-connection PRAGMA'ы: одним скриптом — один вызов в парсер SQLite вместо четырёх execute.
+# journal_mode=WAL сюда не входит: это персистентная настройка файла БД, ставится один раз в init_db.
+# cache_size=-64000 — до 64 МБ page cache на соединение (цена: до ~64 МБ RSS),
+# temp_store=MEMORY — сортировки/временные B-деревья в RAM, а не во временных файлах.
+# busy_timeout=30000 — при всплесках записей из нескольких корутин ждём лок до 30 с, а не падаем с SQLITE_BUSY.
+_CONNECTION_PRAGMAS = """
+PRAGMA synchronous=NORMAL;
+PRAGMA foreign_keys=ON;
+PRAGMA busy_timeout=30000;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-64000;
+"""
+
+# Только для файловых БД (для :memory: бессмысленны):
+# mmap_size — чтение страниц через page cache ОС без read()-сисколлов,
+# wal_autocheckpoint — checkpoint каждые ~1000 страниц (4 МБ) WAL,
+# journal_size_limit — после checkpoint'а WAL усекается до 64 МБ, а не растёт бесконечно.
+_FILE_PRAGMAS = """
+PRAGMA mmap_size=268435456;
+PRAGMA wal_autocheckpoint=1000;
+PRAGMA journal_size_limit=67108864;
+"""
+
+# INSERT/UPDATE ... RETURNING — с SQLite 3.35; на более старых сборках берём cursor.lastrowid
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+_RETURNING_ID = " RETURNING id" if _HAS_RETURNING else ""
+
+# Маркер «аргумент не передан» — отличает его от явного None (= очистить поле)
+_UNSET: Any = object()
+
+# Сколько секунд get_oauth_token отдаёт токен из памяти процесса (токены меняются только при refresh)
+TOKEN_CACHE_TTL = 30.0
+
+# SQLITE_TRACE=1 — каждое выполняемое statement'ом SQL пишется в лог на уровне DEBUG
+# (set_trace_callback). Только для отладки: колбэк вызывается на каждый запрос.
+SQL_TRACE = os.getenv("SQLITE_TRACE", "").strip() == "1"
+
+# Сколько read-only соединений держим в пуле (WAL: читатели не блокируют писателя и друг друга)
+READER_POOL_SIZE = 4
+# Сколько секунд ждём свободного читателя (как busy_timeout); дальше — OperationalError, а не
+# вечное ожидание, если соединения пула заняты брошенными/медленными iter_*-генераторами
+READER_ACQUIRE_TIMEOUT = 30.0
+
+
+if orjson is not None:
+    def _json_dumps(obj: Any) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+    _json_loads = orjson.loads
+else:
+    def _json_dumps(obj: Any) -> str:
+        return json.dumps(obj, ensure_ascii=False)
+
+    _json_loads = json.loads
+
+
+def _convert_json(blob: bytes) -> Optional[Dict[str, Any]]:
+    # NULL до конвертера не доходит; пустая/битая строка -> None (как и раньше при ручном json.loads)
+    try:
+        return _json_loads(blob)
+    except ValueError:
+        return None
+
+
+def _json_param(obj: Optional[Dict[str, Any]]) -> Optional[str]:
+    # extra/meta_json -> JSON-текст для параметра запроса, None -> NULL. Кодируем явно, а не через
+    # sqlite3.register_adapter(dict, ...): адаптер глобален для всего процесса (SQLAlchemy, jobstore)
+    return _json_dumps(obj) if obj is not None else None
+
+
+# Поля dataclass (Task.extra, Note.extra, ConversationMessage.meta_json) декодируются лениво
+# через _LazyJSON. Для выборок без dataclass (iter_task_columns) колонка выбирается как
+# `col AS "col [JSON]"` (PARSE_COLNAMES) — тогда декодирует сам модуль sqlite3 при чтении ячейки.
+sqlite3.register_converter("JSON", _convert_json)
 
 
 # -------------------
 # Dataclasses (DTO)
 # -------------------
 
+class _LazyJSON:
+    """
+    Дескриптор поля dataclass: принимает сырой JSON-текст из БД и декодирует его
+    только при первом чтении атрибута (результат кэшируется). dict/None кладутся как есть.
+    """
+
+    def __set_name__(self, owner: type, name: str) -> None:
+        self._slot = "_" + name
+
+    def __get__(self, obj: Any, objtype: Optional[type] = None) -> Any:
+        if obj is None:
+            # dataclass: AttributeError при доступе через класс = «у поля нет значения по умолчанию»
+            raise AttributeError(self._slot[1:])
+        value = obj.__dict__[self._slot]
+        if isinstance(value, (str, bytes)):
+            value = obj.__dict__[self._slot] = _convert_json(value)
+        return value
+
+    def __set__(self, obj: Any, value: Any) -> None:
+        obj.__dict__[self._slot] = value
+
+
 @dataclass
 class Task:
     id: int
@@ -42,7 +180,7 @@ class Task:
     updated_at: Epoch
     source: Optional[str]
     source_agent: Optional[str]
-    extra: Optional[Dict[str, Any]]
+    extra: Optional[Dict[str, Any]] = _LazyJSON()  # JSON декодируется при первом обращении
     # Calendar sync
     calendar_id: Optional[str]
     calendar_event_id: Optional[str]
@@ -54,6 +192,210 @@ class Task:
     last_modified: Epoch
 
 
+# Колонки tasks строго в порядке полей Task — единый источник для всех SELECT'ов по задачам
+_TASK_COLS: Tuple[str, ...] = (
+    "id", "user_id", "text", "raw_text", "status", "due_at", "created_at", "updated_at",
+    "source", "source_agent", "extra",
+    "calendar_id", "calendar_event_id", "calendar_event_etag", "google_updated_at",
+    "recurrence", "person_id", "notes", "last_modified",
+)
+# extra выбирается сырым текстом: декодирует его Task.extra (_LazyJSON) только при обращении
+_TASK_SELECT = "SELECT " + ", ".join(_TASK_COLS) + " FROM tasks"
+
+# Вставка задачи: колонки в порядке _TASK_COLS (без id). Хвост (RETURNING / ";") добавляет вызывающий.
+_SQL_INSERT_TASK = (
+    "INSERT INTO tasks (" + ", ".join(_TASK_COLS[1:]) + ") "
+    "VALUES (" + ", ".join("?" * (len(_TASK_COLS) - 1)) + ")"
+)
+_SQL_INSERT_TASK_RETURNING = f"{_SQL_INSERT_TASK} RETURNING {', '.join(_TASK_COLS)};"
+
+# Поиск по истории разговора: по FTS5-индексу и запасной перебор, оба — сначала новые
+_CONVERSATION_COLS = "id, user_id, role, content, meta_json, ts_epoch, created_at, updated_at"
+_SQL_PRUNE_CONVERSATION = (
+    "DELETE FROM conversation_memory WHERE user_id=? AND ts_epoch < ("
+    "SELECT ts_epoch FROM conversation_memory WHERE user_id=? ORDER BY ts_epoch DESC LIMIT 1 OFFSET ?);"
+)
+_SQL_SEARCH_CONVERSATION_FTS = (
+    "SELECT " + ", ".join("cm." + c for c in _CONVERSATION_COLS.split(", ")) + " "
+    "FROM conversation_fts JOIN conversation_memory cm ON cm.id = conversation_fts.rowid "
+    "WHERE conversation_fts MATCH ? AND cm.user_id=? ORDER BY cm.ts_epoch DESC, cm.id DESC LIMIT ?;"
+)
+_SQL_SEARCH_CONVERSATION_SCAN = (
+    "SELECT " + _CONVERSATION_COLS + " FROM conversation_memory "
+    "WHERE user_id=? ORDER BY ts_epoch DESC, id DESC;"
+)
+# Слово для поиска — как токен unicode61: буквы и цифры, "_" и пунктуация — разделители
+_SEARCH_WORD_RE = re.compile(r"[^\W_]+")
+
+# Готовые SQL-строки для типовых форм запросов: текст statement'а не меняется от вызова к вызову,
+# поэтому кэш подготовленных statement'ов соединения (cached_statements) всегда попадает.
+# LIMIT/OFFSET — параметры (LIMIT -1 = без ограничения).
+_TASK_ORDER_SQL: Dict[str, str] = {
+    "due_at_nulls_last": "ORDER BY (due_at IS NULL), due_at ASC, id ASC",
+    "created_desc": "ORDER BY created_at DESC",
+    "updated_desc": "ORDER BY updated_at DESC",
+}
+
+
+def _where(*clauses: str) -> str:
+    parts = [c for c in clauses if c]
+    return ("WHERE " + " AND ".join(parts)) if parts else ""
+
+
+# (есть user_id, есть status, order_by) -> SQL
+_LIST_TASKS_SQL: Dict[Tuple[bool, bool, str], str] = {
+    (has_user, has_status, order): (
+        f"{_TASK_SELECT} {_where('user_id=?' if has_user else '', 'status=?' if has_status else '')} "
+        f"{order_sql} LIMIT ? OFFSET ?;"
+    )
+    for has_user in (False, True)
+    for has_status in (False, True)
+    for order, order_sql in _TASK_ORDER_SQL.items()
+}
+
+_NOTE_SELECT = (
+    "SELECT id, user_id, text, raw_text, created_at, updated_at, source, source_agent, extra "
+    "FROM notes"
+)
+
+# (есть user_id, order_by == "created_desc") -> SQL
+_LIST_NOTES_SQL: Dict[Tuple[bool, bool], str] = {
+    (has_user, created_desc): (
+        f"{_NOTE_SELECT} {_where('user_id=?' if has_user else '')} "
+        f"{'ORDER BY created_at DESC' if created_desc else 'ORDER BY id ASC'} LIMIT ? OFFSET ?;"
+    )
+    for has_user in (False, True)
+    for created_desc in (False, True)
+}
+
+_SQL_SELECT_TASK_BY_ID = f"{_TASK_SELECT} WHERE id=?;"
+_SQL_SELECT_TASK_BY_CAL_EVENT = (
+    f"{_TASK_SELECT} WHERE user_id=? AND calendar_id=? AND calendar_event_id=? LIMIT 1;"
+)
+_SQL_TASKS_MISSING_LINK = (
+    f"{_TASK_SELECT} WHERE user_id=? AND calendar_event_id IS NULL AND status='open';"
+)
+_SQL_SELECT_NOTE_BY_ID = f"{_NOTE_SELECT} WHERE id=?;"
+
+# list_upcoming_tasks: (есть due_to, есть user_id) -> SQL
+_UPCOMING_TASKS_SQL: Dict[Tuple[bool, bool], str] = {
+    (has_to, has_user): (
+        f"{_TASK_SELECT} "
+        + _where(
+            "status=?",
+            "due_at IS NOT NULL",
+            "due_at >= ?",
+            "due_at <= ?" if has_to else "",
+            "user_id=?" if has_user else "",
+        )
+        + " ORDER BY due_at ASC, id ASC LIMIT ?;"
+    )
+    for has_to in (False, True)
+    for has_user in (False, True)
+}
+
+
+# Снятые в v14 избыточные индексы (DROP INDEX IF EXISTS при апгрейде):
+# idx_tasks_due_at, idx_tasks_user_due -> idx_tasks_status_due / idx_tasks_user_status_due / *_nulls_last;
+# idx_tasks_user_status -> префикс idx_tasks_user_status_due_nulls_last;
+# idx_tasks_last_modified -> префикс idx_tasks_lastmod_user; idx_tasks_upcoming -> idx_tasks_user_status_due;
+# idx_tasks_calendar_link -> idx_tasks_cal_unique (создаётся заново, только если уникальный не построился);
+# idx_tasks_google_updated — ни одного запроса по google_updated_at;
+# idx_cm_user_role -> idx_cm_user_ts; idx_oauth_provider, idx_cs_user — дубли первичных ключей.
+_DROPPED_INDEXES = (
+    "idx_tasks_due_at", "idx_tasks_user_status", "idx_tasks_user_due", "idx_tasks_last_modified",
+    "idx_tasks_upcoming", "idx_tasks_google_updated", "idx_oauth_provider", "idx_cs_user",
+    "idx_cm_user_role", "idx_tasks_calendar_link",
+)
+
+# Служебные метки времени: выставляются при любом реальном изменении, в сравнении не участвуют
+_TOUCH_COLS = ("updated_at", "last_modified")
+
+
+@lru_cache(maxsize=256)
+def _select_task_cols_sql(columns: Tuple[str, ...]) -> str:
+    return f"SELECT {', '.join(columns)} FROM tasks WHERE id=?;"
+
+
+# Лимит параметров в одном запросе: SQLITE_MAX_VARIABLE_NUMBER в старых сборках = 999
+_IDS_CHUNK = 900
+
+
+@lru_cache(maxsize=64)
+def _tasks_by_ids_sql(id_count: int) -> str:
+    # SQL для get_tasks_by_ids: одна строка на размер пачки id
+    return f"{_TASK_SELECT} WHERE id IN ({','.join('?' * id_count)});"
+
+
+# есть user_id -> SQL для list_task_ids_due_between
+_TASK_IDS_DUE_BETWEEN_SQL: Dict[bool, str] = {
+    has_user: (
+        "SELECT id FROM tasks WHERE status=? AND due_at IS NOT NULL AND due_at >= ? AND due_at <= ?"
+        + (" AND user_id=?" if has_user else "")
+        + " ORDER BY due_at ASC, id ASC;"
+    )
+    for has_user in (False, True)
+}
+
+
+@lru_cache(maxsize=64)
+def _task_columns_sql(columns: Tuple[str, ...], has_user: bool, has_status: bool) -> str:
+    # SQL для iter_task_columns: одна строка на форму запроса (колонки + набор фильтров)
+    select = ", ".join('extra AS "extra [JSON]"' if c == "extra" else c for c in columns)
+    clauses = [c for c, on in (("user_id=?", has_user), ("status=?", has_status)) if on]
+    where = (" WHERE " + " AND ".join(clauses)) if clauses else ""
+    return f"SELECT {select} FROM tasks{where} ORDER BY id;"
+
+
+@lru_cache(maxsize=64)
+def _conversation_messages_sql(role_count: int, descending: bool) -> str:
+    # SQL для list_conversation_messages: форма = число ролей в фильтре + направление сортировки
+    roles = f" AND role IN ({','.join('?' * role_count)})" if role_count else ""
+    return (
+        f"SELECT {_CONVERSATION_COLS} FROM conversation_memory WHERE user_id=?{roles} "
+        f"ORDER BY ts_epoch {'DESC' if descending else 'ASC'} LIMIT ? OFFSET ?;"
+    )
+
+
+def _trace_sql(statement: str) -> None:
+    logger.debug("SQL: %s", statement)
+
+
+def _same_value(column: str, new: Any, old: Any) -> bool:
+    # extra — JSON-текст с обеих сторон, но записанный, возможно, другим сериализатором
+    # (json/orjson, порядок ключей) — сравниваем в декодированном виде
+    if column == "extra" and isinstance(new, str):
+        return isinstance(old, (str, bytes)) and _convert_json(old) == _convert_json(new)
+    return new == old
+
+
+@lru_cache(maxsize=256)
+def _update_task_sql(columns: Tuple[str, ...], returning: bool = False) -> str:
+    # Одна и та же строка SQL на каждый набор изменяемых колонок (их порядок фиксирован),
+    # без пересборки SET-части на каждый вызов update_task
+    sql = f"UPDATE tasks SET {', '.join(c + '=?' for c in columns)} WHERE id=?"
+    return f"{sql} RETURNING {', '.join(_TASK_COLS)};" if returning else sql + ";"
+
+
+# (есть user_id) -> SQL
+_TASKS_MODIFIED_SINCE_SQL: Dict[bool, str] = {
+    has_user: (
+        f"{_TASK_SELECT} {_where('last_modified > ?', 'user_id=?' if has_user else '')} "
+        "ORDER BY last_modified ASC;"
+    )
+    for has_user in (False, True)
+}
+
+# (есть user_id) -> SQL: фильтр по полю extra прямо в SQLite (JSON1), без json-декодирования строк в Python
+_TASKS_BY_EXTRA_SQL: Dict[bool, str] = {
+    has_user: (
+        f"{_TASK_SELECT} {_where('json_extract(extra, ?) = ?', 'user_id=?' if has_user else '')} "
+        "ORDER BY id ASC;"
+    )
+    for has_user in (False, True)
+}
+
+
 @dataclass
 class Note:
     id: int
@@ -64,7 +406,7 @@ class Note:
     updated_at: Epoch
     source: Optional[str]
     source_agent: Optional[str]
-    extra: Optional[Dict[str, Any]]
+    extra: Optional[Dict[str, Any]] = _LazyJSON()  # как Task.extra
 
 
 @dataclass
@@ -86,7 +428,7 @@ class ConversationMessage:
     user_id: int
     role: str            # 'user' | 'assistant' | 'system'
     content: str
-    meta_json: Optional[Dict[str, Any]]
+    meta_json: Optional[Dict[str, Any]] = _LazyJSON()  # декодируется при первом обращении
     ts_epoch: Epoch      # время сообщения (UTC)
     created_at: Epoch
     updated_at: Epoch
@@ -109,150 +451,365 @@ class MemorySQLite:
     SQLite-backed storage for tasks and notes + calendar sync + oauth tokens + conversational memory.
     """
 
-    def __init__(self, db_path: Union[str, Path] = ":memory:") -> None:
+    def __init__(self, db_path: Union[str, Path] = ":memory:", *, readers: int = READER_POOL_SIZE) -> None:
         self.db_path = str(db_path)
+        self._in_memory = self.db_path == ":memory:"
+        # Один долгоживущий писатель (SQLite всё равно допускает только одного) под локом
+        self._write_lock = threading.RLock()
+        # Поток, открывший transaction(): его чтения идут через писателя, чтобы видеть свои же
+        # незакоммиченные записи (читатели пула видят только закоммиченное)
+        self._tx_owner: Optional[int] = None
+        # (user_id, provider) -> (monotonic-время записи, токен или None)
+        self._token_cache: Dict[Tuple[str, str], Tuple[float, Optional[OAuthToken]]] = {}
+        self._token_cache_lock = threading.Lock()
+        self._token_cache_gen = 0  # растёт при каждой инвалидации: чтение, начатое до неё, в кэш не попадёт
+        self._writer = self._open()
         self.init_db()
-
-    @contextmanager
-    def _connect(self):
+        with self._for_write() as con:
+            self._has_fts = self._table_exists(con, "conversation_fts")
+        # Пул читателей открываем после init_db: mode=ro требует уже существующий файл.
+        # Для :memory: у каждого соединения своя БД — читаем через писателя.
+        # SimpleQueue (C): get/put без Condition-объектов Queue — пулу не нужны join/maxsize
+        self._readers: "queue.SimpleQueue[sqlite3.Connection]" = queue.SimpleQueue()
+        self._reader_count = 0 if self._in_memory else max(readers, 0)
+        # Соединения текущего пула: читатель, выданный до reset_db/close, при возврате
+        # в этот набор не входит и закрывается, а не попадает в новый пул со старым файлом
+        self._pool_members: set = set()
+        self._pool_lock = threading.Lock()
+        self._open_readers()
+
+    def _open_readers(self) -> None:
+        with self._pool_lock:
+            for _ in range(self._reader_count):
+                con = self._open(read_only=True)
+                self._pool_members.add(con)
+                self._readers.put(con)
+            self._has_readers = bool(self._pool_members)
+
+    def _close_readers(self) -> None:
+        # Сначала переключаем чтение на писателя, затем закрываем свободные соединения пула;
+        # занятые закроются при возврате (_release_reader)
+        with self._pool_lock:
+            self._has_readers = False
+            self._pool_members = set()
+            while True:
+                try:
+                    self._readers.get_nowait().close()
+                except queue.Empty:
+                    break
+
+    def _release_reader(self, con: sqlite3.Connection) -> None:
+        with self._pool_lock:
+            if con in self._pool_members:
+                self._readers.put(con)
+                return
+        con.close()
+
+    def _open(self, *, read_only: bool = False) -> sqlite3.Connection:
+        if read_only:
+            target, uri = Path(self.db_path).resolve().as_uri() + "?mode=ro", True
+        else:
+            target, uri = self.db_path, False
         con = sqlite3.connect(
-            self.db_path,
-            detect_types=sqlite3.PARSE_DECLTYPES,
+            target,
+            # Только PARSE_COLNAMES: в схеме нет колонок с объявленным типом под конвертер,
+            # а PARSE_DECLTYPES заставлял модуль искать конвертер по decltype каждой колонки
+            detect_types=sqlite3.PARSE_COLNAMES,
             isolation_level=None,         # autocommit mode
             check_same_thread=False,
+            cached_statements=256,        # LRU подготовленных statement'ов на соединение (по тексту SQL)
+            uri=uri,
         )
+        # Строки — обычные tuple: Task(*r)/Note(*r) собираются по позиции, обёртка sqlite3.Row
+        # на каждую строку не нужна. Доступ по имени — только там, где он обещан (iter_task_columns).
+        self._configure(con)
+        if read_only:
+            # Вторая страховка поверх mode=ro: любая запись через читателя — сразу ошибка
+            con.execute("PRAGMA query_only=1;")
+        return con
+
+    def _configure(self, con: sqlite3.Connection) -> None:
+        # Продакшен-параметры — один раз на всё время жизни соединения
+        con.executescript(_CONNECTION_PRAGMAS if self._in_memory else _CONNECTION_PRAGMAS + _FILE_PRAGMAS)
+        if SQL_TRACE:
+            con.set_trace_callback(_trace_sql)
+
+    def close(self) -> None:
+        """Закрыть писателя и все соединения пула читателей (teardown/выход процесса)."""
+        self._close_readers()
+        with self._write_lock:
+            try:
+                # Рекомендация SQLite: optimize перед закрытием — статистика для следующего запуска
+                self._writer.execute("PRAGMA optimize;")
+            except sqlite3.ProgrammingError:
+                return  # уже закрыто (повторный close)
+            self._writer.close()
+
+    @contextmanager
+    def _for_write(self) -> Iterator[sqlite3.Connection]:
+        """Общий писатель: записи сериализуются локом (SQLite всё равно пускает одного писателя)."""
+        with self._write_lock:
+            yield self._writer
+
+    @contextmanager
+    def _for_read(self) -> Iterator[sqlite3.Connection]:
+        """
+        Соединение из пула read-only читателей; без пула (:memory:) или внутри transaction()
+        текущего потока — писатель под локом.
+        """
+        if not self._has_readers or self._tx_owner == threading.get_ident():
+            with self._write_lock:
+                yield self._writer
+            return
+        try:
+            con = self._readers.get(timeout=READER_ACQUIRE_TIMEOUT)
+        except queue.Empty:
+            raise sqlite3.OperationalError(
+                f"reader pool exhausted: no free connection within {READER_ACQUIRE_TIMEOUT:g}s"
+            ) from None
         try:
-            # Продакшен-параметры
-            con.execute("PRAGMA journal_mode=WAL;")
-            con.execute("PRAGMA synchronous=NORMAL;")
-            con.execute("PRAGMA foreign_keys=ON;")
-            con.execute("PRAGMA busy_timeout=3000;")
             yield con
         finally:
-            con.close()
+            self._release_reader(con)
+
+    def _iter_rows(
+        self, sql: str, params: Any = (), *, row_factory: Optional[Any] = None
+    ) -> Iterator[Any]:
+        """
+        Строки запроса для iter_*-генераторов. Через читателя пула — потоково, по мере итерации
+        (соединение занято, пока генератор не исчерпан или не закрыт). Через писателя (:memory:,
+        внутри transaction()) — строки выбираются целиком до первого yield: лок писателя не держится,
+        пока генератор приостановлен, и не блокирует записи из других потоков.
+        """
+        with self._for_read() as con:
+            cur = con.cursor()
+            if row_factory is not None:
+                cur.row_factory = row_factory
+            cur.execute(sql, params)
+            if con is not self._writer:
+                yield from cur
+                return
+            rows = cur.fetchall()
+        yield from rows
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """
+        BEGIN IMMEDIATE ... COMMIT на писателе: N записей — один коммит (и один fsync) вместо N.
+        Вложенные вызовы (в т.ч. add_task/update_task внутри блока) идут в уже открытую транзакцию,
+        а чтения этого же потока (get_task, list_tasks, ...) видят её незакоммиченные записи.
+        """
+        with self._for_write() as con:
+            if con.in_transaction:
+                yield con
+                return
+            con.execute("BEGIN IMMEDIATE;")
+            self._tx_owner = threading.get_ident()
+            try:
+                yield con
+            except BaseException:
+                con.execute("ROLLBACK;")
+                raise
+            finally:
+                self._tx_owner = None
+            con.execute("COMMIT;")
 
     # -------------------
     # Init & Migrations
     # -------------------
 
     def init_db(self) -> None:
-        with self._connect() as con:
+        with self._for_write() as con:
+            # Схема уже актуальна — одно чтение PRAGMA user_version вместо DDL и проверок
+            if self._get_version(con) >= SCHEMA_VERSION:
+                return
             cur = con.cursor()
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS schema_version (
-                    version INTEGER NOT NULL
-                );
-            """)
-            cur.execute("SELECT COUNT(*) FROM schema_version;")
-            if cur.fetchone()[0] == 0:
-                cur.execute("INSERT INTO schema_version(version) VALUES (0);")
-
-            # base tables
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS tasks (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    text TEXT NOT NULL,
-                    raw_text TEXT,
-                    status TEXT NOT NULL DEFAULT 'open' CHECK (status IN ('open','done','archived')),
-                    due_at INTEGER,
-                    created_at INTEGER NOT NULL,
-                    updated_at INTEGER NOT NULL,
-                    source TEXT,
-                    source_agent TEXT,
-                    extra TEXT,
-                    calendar_id TEXT,
-                    calendar_event_id TEXT,
-                    calendar_event_etag TEXT,
-                    google_updated_at INTEGER,
-                    recurrence TEXT,
-                    person_id INTEGER,
-                    notes TEXT,
-                    last_modified INTEGER
-                );
-            """)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS notes (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    text TEXT NOT NULL,
-                    raw_text TEXT,
-                    created_at INTEGER NOT NULL,
-                    updated_at INTEGER NOT NULL,
-                    source TEXT,
-                    source_agent TEXT,
-                    extra TEXT
-                );
-            """)
-
-            # tokens table
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS oauth_tokens (
-                    user_id TEXT NOT NULL,
-                    provider TEXT NOT NULL,
-                    token_json TEXT NOT NULL,
-                    expiry INTEGER,
-                    scopes TEXT,
-                    created_at INTEGER NOT NULL,
-                    updated_at INTEGER NOT NULL,
-                    PRIMARY KEY (user_id, provider)
-                );
-            """)
-
-            # --- Conversational memory tables (новое в v5)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS conversation_memory (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    role TEXT NOT NULL CHECK (role IN ('user','assistant','system')),
-                    content TEXT NOT NULL,
-                    meta_json TEXT,
-                    ts_epoch INTEGER NOT NULL,
-                    created_at INTEGER NOT NULL,
-                    updated_at INTEGER NOT NULL
-                );
-            """)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS conversation_summary (
-                    user_id INTEGER PRIMARY KEY,
-                    summary_text TEXT NOT NULL,
-                    updated_at INTEGER NOT NULL,
-                    created_at INTEGER NOT NULL
-                );
-            """)
-
-            self._migrate(con)
-            self._ensure_indexes(con)
+            # page_size действует только для ещё пустой БД и до перехода в WAL
+            cur.execute("PRAGMA page_size=4096;")
+            # auto_vacuum тоже задаётся только до создания первой таблицы: новая БД сразу
+            # INCREMENTAL — свободные страницы после удалений возвращает compact(), без полного VACUUM
+            if cur.execute("PRAGMA page_count;").fetchone()[0] == 0:
+                cur.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+            # WAL хранится в самом файле БД — достаточно выставить один раз.
+            # Для :memory: WAL неприменим (SQLite оставит 'memory') — не дёргаем зря.
+            if not self._in_memory:
+                mode = cur.execute("PRAGMA journal_mode;").fetchone()[0]
+                if str(mode).lower() != "wal":
+                    cur.execute("PRAGMA journal_mode=WAL;")
+
+            # DDL и миграции — одной транзакцией: один коммит вместо коммита на каждый ALTER/CREATE
+            with self.transaction() as con:
+                # base tables
+                cur.execute(_TASKS_TABLE_SQL.format(name="tasks"))
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS notes (
+                        id INTEGER PRIMARY KEY NOT NULL,
+                        user_id INTEGER NOT NULL,
+                        text TEXT NOT NULL,
+                        raw_text TEXT,
+                        created_at INTEGER NOT NULL,
+                        updated_at INTEGER NOT NULL,
+                        source TEXT,
+                        source_agent TEXT,
+                        extra TEXT
+                    );
+                """)
+
+                # tokens table
+                # WITHOUT ROWID: строки лежат прямо в B-дереве первичного ключа (user_id, provider) —
+                # get_oauth_token делает один спуск по дереву вместо двух (индекс PK -> rowid-таблица)
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS oauth_tokens (
+                        user_id TEXT NOT NULL,
+                        provider TEXT NOT NULL,
+                        token_json TEXT NOT NULL,
+                        expiry INTEGER,
+                        scopes TEXT,
+                        created_at INTEGER NOT NULL,
+                        updated_at INTEGER NOT NULL,
+                        PRIMARY KEY (user_id, provider)
+                    ) WITHOUT ROWID;
+                """)
+
+                # --- Conversational memory tables (новое в v5)
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS conversation_memory (
+                        id INTEGER PRIMARY KEY NOT NULL,
+                        user_id INTEGER NOT NULL,
+                        role TEXT NOT NULL CHECK (role IN ('user','assistant','system')),
+                        content TEXT NOT NULL,
+                        meta_json TEXT,
+                        ts_epoch INTEGER NOT NULL,
+                        created_at INTEGER NOT NULL,
+                        updated_at INTEGER NOT NULL
+                    );
+                """)
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS conversation_summary (
+                        user_id INTEGER PRIMARY KEY,
+                        summary_text TEXT NOT NULL,
+                        updated_at INTEGER NOT NULL,
+                        created_at INTEGER NOT NULL
+                    );
+                """)
+
+                self._migrate(con)
+                self._ensure_indexes(con)
+                self._ensure_conversation_fts(con)
+                # Статистика sqlite_stat1 для планировщика — после создания/изменения индексов
+                con.execute("ANALYZE;")
 
     def _ensure_indexes(self, con: sqlite3.Connection) -> None:
         cur = con.cursor()
+        # v14: индексы, которые перекрыты составными/частичными ниже (префикс или тот же поиск)
+        # и не выбираются планировщиком ни для одного запроса, — только замедляли каждую запись
+        for name in _DROPPED_INDEXES:
+            cur.execute(f"DROP INDEX IF EXISTS {name};")
         # tasks indexes
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_tasks_due_at ON tasks(due_at);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_tasks_user_status ON tasks(user_id, status);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_tasks_user_due ON tasks(user_id, due_at);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_tasks_calendar_link ON tasks(user_id, calendar_id, calendar_event_id);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_tasks_last_modified ON tasks(last_modified);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_tasks_google_updated ON tasks(google_updated_at);")
-        # oauth indexes
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_oauth_provider ON oauth_tokens(provider);")
+        # list_upcoming_tasks без user_id: status=? + диапазон due_at + ORDER BY due_at, id.
+        # Частичный индекс не хранит задачи без срока (их запрос всё равно отбрасывает).
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_tasks_status_due ON tasks(status, due_at, id) "
+            "WHERE due_at IS NOT NULL;"
+        )
+        # list_tasks (order_by="due_at_nulls_last"): индекс по тому же выражению, что и ORDER BY,
+        # отдаёт строки уже в нужном порядке — без временного B-дерева для сортировки.
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_tasks_user_due_nulls_last "
+            "ON tasks(user_id, (due_at IS NULL), due_at, id);"
+        )
+        # С фильтром по статусу (list_tasks(user_id, status="open")): поиск по обоим равенствам
+        # сразу в нужном порядке — без перебора накопившихся done/archived задач пользователя
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_tasks_user_status_due_nulls_last "
+            "ON tasks(user_id, status, (due_at IS NULL), due_at, id);"
+        )
+        # То же без user_id (сводки по всем пользователям: list_tasks(status=..., limit=N))
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_tasks_due_nulls_last "
+            "ON tasks((due_at IS NULL), due_at, id);"
+        )
+        # Частичные индексы под опрос синка: WHERE запросов повторяет предикат индекса дословно
+        # (status='open' литералом, не параметром), иначе планировщик их не выберет.
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_tasks_missing_link ON tasks(user_id) "
+            "WHERE calendar_event_id IS NULL AND status='open';"
+        )
+        # list_upcoming_tasks для прочих статусов (status=? параметром): равенства -> диапазон due_at
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_tasks_user_status_due ON tasks(user_id, status, due_at) "
+            "WHERE due_at IS NOT NULL;"
+        )
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_tasks_lastmod_user ON tasks(last_modified, user_id);")
+        # Одна задача на событие календаря — цель ON CONFLICT для upsert_task_by_calendar_event.
+        # Частичный: задач без привязки (NULL) может быть сколько угодно.
+        try:
+            cur.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS idx_tasks_cal_unique "
+                "ON tasks(user_id, calendar_id, calendar_event_id) WHERE calendar_event_id IS NOT NULL;"
+            )
+        except sqlite3.IntegrityError:
+            # В старой БД уже есть дубли привязок — не теряем данные; upsert уйдёт в запасной путь,
+            # а поиск по событию обслужит обычный (неуникальный) индекс
+            logger.warning("idx_tasks_cal_unique не создан: в tasks есть задачи с одинаковым событием календаря")
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_tasks_calendar_link "
+                "ON tasks(user_id, calendar_id, calendar_event_id);"
+            )
+        # oauth_tokens и conversation_summary ищутся только по первичному ключу — отдельные индексы не нужны
         # conversational memory indexes
         cur.execute("CREATE INDEX IF NOT EXISTS idx_cm_user_ts ON conversation_memory(user_id, ts_epoch);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_cm_user_role ON conversation_memory(user_id, role);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_cs_user ON conversation_summary(user_id);")
+
+    def _ensure_conversation_fts(self, con: sqlite3.Connection) -> None:
+        """
+        Полнотекстовый индекс по conversation_memory.content (FTS5, external content):
+        текст не дублируется, индекс поддерживают триггеры. Без FTS5 в сборке SQLite —
+        пропускаем, search_conversation_messages перейдёт на построчный поиск.
+        """
+        if self._table_exists(con, "conversation_fts"):
+            return
+        try:
+            con.execute(
+                "CREATE VIRTUAL TABLE conversation_fts USING fts5("
+                "content, content='conversation_memory', content_rowid='id', tokenize='unicode61');"
+            )
+        except sqlite3.OperationalError:
+            logger.warning("FTS5 недоступен в этой сборке SQLite: поиск по истории без индекса")
+            return
+        con.execute("""
+            CREATE TRIGGER IF NOT EXISTS conversation_fts_ai AFTER INSERT ON conversation_memory BEGIN
+                INSERT INTO conversation_fts(rowid, content) VALUES (new.id, new.content);
+            END;
+        """)
+        con.execute("""
+            CREATE TRIGGER IF NOT EXISTS conversation_fts_ad AFTER DELETE ON conversation_memory BEGIN
+                INSERT INTO conversation_fts(conversation_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            END;
+        """)
+        con.execute("""
+            CREATE TRIGGER IF NOT EXISTS conversation_fts_au AFTER UPDATE OF content ON conversation_memory BEGIN
+                INSERT INTO conversation_fts(conversation_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                INSERT INTO conversation_fts(rowid, content) VALUES (new.id, new.content);
+            END;
+        """)
+        # Апгрейд: проиндексировать уже накопленную историю
+        con.execute("INSERT INTO conversation_fts(conversation_fts) VALUES ('rebuild');")
 
     def _get_version(self, con: sqlite3.Connection) -> int:
-        cur = con.cursor()
-        cur.execute("SELECT version FROM schema_version LIMIT 1;")
-        row = cur.fetchone()
-        return int(row[0]) if row else 0
+        # Версия схемы — во встроенном PRAGMA user_version (заголовок файла БД).
+        # Старые БД с таблицей schema_version имеют user_version=0 и один раз проходят миграции.
+        return int(con.execute("PRAGMA user_version;").fetchone()[0])
 
     def _set_version(self, con: sqlite3.Connection, v: int) -> None:
-        con.execute("UPDATE schema_version SET version=?;", (v,))
+        # PRAGMA не принимает параметры — подставляем заведомо целое число
+        con.execute(f"PRAGMA user_version={int(v)};")
+
+    def _columns(self, con: sqlite3.Connection, table: str) -> set:
+        # Один PRAGMA table_info на таблицу — дальше проверки по множеству имён
+        return {r[1] for r in con.execute(f"PRAGMA table_info({table});")}
 
     def _column_exists(self, con: sqlite3.Connection, table: str, column: str) -> bool:
-        cur = con.cursor()
-        cur.execute(f"PRAGMA table_info({table});")
-        return any(row[1] == column for row in cur.fetchall())
+        return column in self._columns(con, table)
 
     def _table_exists(self, con: sqlite3.Connection, table: str) -> bool:
         cur = con.cursor()
@@ -264,9 +821,15 @@ class MemorySQLite:
         Акуратно добавляем недостающие столбцы/таблицы.
         """
         current = self._get_version(con)
+        if current >= SCHEMA_VERSION:
+            return
+
+        existing = self._columns(con, "tasks")
+        # Все таблицы и их DDL — одним запросом к sqlite_master вместо отдельной проверки на таблицу
+        tables = {name: sql or "" for name, sql in con.execute("SELECT name, sql FROM sqlite_master WHERE type='table';")}
 
         # v1: due_at для tasks (историческое)
-        if not self._column_exists(con, "tasks", "due_at"):
+        if "due_at" not in existing:
             con.execute("ALTER TABLE tasks ADD COLUMN due_at INTEGER;")
             current = max(current, 1)
 
@@ -282,7 +845,7 @@ class MemorySQLite:
             ("notes", "TEXT"),
             ("last_modified", "INTEGER"),
         ):
-            if not self._column_exists(con, "tasks", col):
+            if col not in existing:
                 columns_to_add.append((col, typ))
         for col, typ in columns_to_add:
             con.execute(f"ALTER TABLE tasks ADD COLUMN {col} {typ};")
@@ -292,13 +855,32 @@ class MemorySQLite:
                 con.execute("UPDATE tasks SET last_modified = COALESCE(updated_at, strftime('%s','now'));")
             current = max(current, 3)
 
+        # v15: tasks без AUTOINCREMENT (БД, созданные схемой v14) — пересборка таблицы, чтобы id
+        # удалённых задач больше не переиспользовались; индексы пересоздаст _ensure_indexes
+        if "AUTOINCREMENT" not in tables.get("tasks", "").upper():
+            cols = ", ".join(_TASK_COLS)
+            con.execute(_TASKS_TABLE_SQL.format(name="tasks_new"))
+            con.execute(f"INSERT INTO tasks_new ({cols}) SELECT {cols} FROM tasks;")
+            con.execute("DROP TABLE tasks;")
+            con.execute("ALTER TABLE tasks_new RENAME TO tasks;")
+
         # v4: oauth_tokens уже создавалась в init_db
 
+        # v6: индекс под сортировку list_tasks — создаётся в _ensure_indexes (init_db, после _migrate)
+        # v7: частичные индексы синка (missing_link, upcoming, lastmod_user) — там же
+        # v9: idx_tasks_due_nulls_last (порядок list_tasks без user_id) — там же
+        # v10: уникальный частичный idx_tasks_cal_unique (upsert по событию календаря) — там же
+        # v11: idx_tasks_user_status_due (list_upcoming_tasks с произвольным статусом) — там же
+        # v12: FTS5-таблица conversation_fts + триггеры — в _ensure_conversation_fts
+        # v13: idx_tasks_user_status_due_nulls_last (list_tasks с user_id и status) — в _ensure_indexes
+        # v14: сняты избыточные индексы (_DROPPED_INDEXES) — там же
+        # v15: tasks снова с AUTOINCREMENT — пересборка выше
+
         # v5: conversational memory tables (если не существуют — создать)
-        if not self._table_exists(con, "conversation_memory"):
+        if "conversation_memory" not in tables:
             con.execute("""
                 CREATE TABLE conversation_memory (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    id INTEGER PRIMARY KEY NOT NULL,
                     user_id INTEGER NOT NULL,
                     role TEXT NOT NULL CHECK (role IN ('user','assistant','system')),
                     content TEXT NOT NULL,
@@ -308,7 +890,7 @@ class MemorySQLite:
                     updated_at INTEGER NOT NULL
                 );
             """)
-        if not self._table_exists(con, "conversation_summary"):
+        if "conversation_summary" not in tables:
             con.execute("""
                 CREATE TABLE conversation_summary (
                     user_id INTEGER PRIMARY KEY,
@@ -317,8 +899,31 @@ class MemorySQLite:
                     created_at INTEGER NOT NULL
                 );
             """)
-        # Индексы (на случай апгрейда)
-        self._ensure_indexes(con)
+        # v8: oauth_tokens -> WITHOUT ROWID (пересборка таблицы; индексы пересоздаст _ensure_indexes)
+        if "oauth_tokens" in tables and "WITHOUT ROWID" not in tables["oauth_tokens"].upper():
+            con.execute("""
+                CREATE TABLE oauth_tokens_new (
+                    user_id TEXT NOT NULL,
+                    provider TEXT NOT NULL,
+                    token_json TEXT NOT NULL,
+                    expiry INTEGER,
+                    scopes TEXT,
+                    created_at INTEGER NOT NULL,
+                    updated_at INTEGER NOT NULL,
+                    PRIMARY KEY (user_id, provider)
+                ) WITHOUT ROWID;
+            """)
+            con.execute("""
+                INSERT INTO oauth_tokens_new (user_id, provider, token_json, expiry, scopes, created_at, updated_at)
+                SELECT user_id, provider, token_json, expiry, scopes, created_at, updated_at FROM oauth_tokens;
+            """)
+            con.execute("DROP TABLE oauth_tokens;")
+            con.execute("ALTER TABLE oauth_tokens_new RENAME TO oauth_tokens;")
+
+        # Индексы (в т.ч. на случай апгрейда) создаёт init_db сразу после _migrate — здесь не дублируем
+
+        # Версия теперь живёт в user_version — legacy-таблица больше не нужна
+        con.execute("DROP TABLE IF EXISTS schema_version;")
 
         if current < SCHEMA_VERSION:
             self._set_version(con, SCHEMA_VERSION)
@@ -329,12 +934,16 @@ class MemorySQLite:
 
     @staticmethod
     def _now_epoch() -> Epoch:
-        return int(time.time())
+        # Целые секунды без промежуточного float
+        return time.time_ns() // 1_000_000_000
 
     @staticmethod
     def _to_epoch(value: Optional[Union[int, float]]) -> Optional[Epoch]:
         if value is None:
             return None
+        if type(value) is int:  # типичный случай — уже epoch из БД/парсера
+            return value if value >= 0 else None
+        # float / строка с числом; NaN, inf и мусор -> None
         try:
             iv = int(value)
             return iv if iv >= 0 else None
@@ -342,19 +951,9 @@ class MemorySQLite:
             return None
 
     @staticmethod
-    def _loads_optional_json(s: Optional[str]) -> Optional[Dict[str, Any]]:
-        if not s:
-            return None
-        try:
-            return json.loads(s)
-        except Exception:
-            return None
-
-    @staticmethod
-    def _dumps_optional_json(obj: Optional[Dict[str, Any]]) -> Optional[str]:
-        if obj is None:
-            return None
-        return json.dumps(obj, ensure_ascii=False)
+    def _inserted_id(cur: sqlite3.Cursor) -> int:
+        # id из RETURNING того же statement'а; запасной путь — lastrowid
+        return int(cur.fetchone()[0]) if _HAS_RETURNING else int(cur.lastrowid)
 
     # -------------------
     # Tasks CRUD
@@ -375,58 +974,142 @@ class MemorySQLite:
         person_id: Optional[int] = None,
         notes: Optional[str] = None,
     ) -> int:
-        created = updated = self._now_epoch()
-        due = self._to_epoch(due_at)
-        extra_json = self._dumps_optional_json(extra)
-        last_modified = updated
-        with self._connect() as con:
+        params = self._task_insert_params(
+            user_id, text, raw_text=raw_text, due_at=due_at, status=status,
+            source=source, source_agent=source_agent, extra=extra,
+            recurrence=recurrence, person_id=person_id, notes=notes,
+        )
+        with self._for_write() as con:
             cur = con.cursor()
-            cur.execute(
+            cur.execute(f"{_SQL_INSERT_TASK}{_RETURNING_ID};", params)
+            return self._inserted_id(cur)
+
+    def add_task_returning(self, user_id: int, text: str, **fields: Any) -> Task:
+        """
+        Как add_task (те же именованные аргументы), но возвращает созданную задачу
+        из INSERT ... RETURNING — без отдельного get_task после вставки.
+        """
+        params = self._task_insert_params(user_id, text, **fields)
+        with self._for_write() as con:
+            if _HAS_RETURNING:
+                r = con.execute(_SQL_INSERT_TASK_RETURNING, params).fetchone()
+            else:
+                cur = con.execute(_SQL_INSERT_TASK + ";", params)
+                r = con.execute(_SQL_SELECT_TASK_BY_ID, (cur.lastrowid,)).fetchone()
+            return self._task_from_row(r)
+
+    def _task_insert_params(
+        self,
+        user_id: int,
+        text: str,
+        *,
+        raw_text: Optional[str] = None,
+        due_at: Optional[Union[int, float]] = None,
+        status: str = "open",
+        source: Optional[str] = None,
+        source_agent: Optional[str] = None,
+        extra: Optional[Dict[str, Any]] = None,
+        recurrence: Optional[str] = None,
+        person_id: Optional[int] = None,
+        notes: Optional[str] = None,
+    ) -> Tuple[Any, ...]:
+        # Параметры для _SQL_INSERT_TASK; календарные поля новой задачи всегда пустые
+        now = self._now_epoch()
+        return (
+            user_id, text, raw_text, status, self._to_epoch(due_at), now, now,
+            source, source_agent, _json_param(extra),
+            None, None, None, None,
+            recurrence, person_id, notes, now,
+        )
+
+    def add_tasks_bulk(self, rows: List[Dict[str, Any]]) -> List[int]:
+        """
+        Массовая вставка задач (импорт, синк календаря): один executemany в одной транзакции.
+        Ключи словарей — как у именованных аргументов add_task. Возвращает id в порядке rows.
+        """
+        if not rows:
+            return []
+        now = self._now_epoch()
+        params = [
+            (
+                r["user_id"], r["text"], r.get("raw_text"), r.get("status", "open"),
+                self._to_epoch(r.get("due_at")), now, now,
+                r.get("source"), r.get("source_agent"), _json_param(r.get("extra")),
+                r.get("recurrence"), r.get("person_id"), r.get("notes"), now,
+            )
+            for r in rows
+        ]
+        with self.transaction() as con:
+            con.executemany(
                 """
                 INSERT INTO tasks (
                     user_id, text, raw_text, status, due_at, created_at, updated_at,
                     source, source_agent, extra,
-                    calendar_id, calendar_event_id, calendar_event_etag, google_updated_at,
                     recurrence, person_id, notes, last_modified
                 )
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
                 """,
-                (
-                    user_id, text, raw_text, status, due, created, updated,
-                    source, source_agent, extra_json,
-                    None, None, None, None,
-                    recurrence, person_id, notes, last_modified,
-                ),
+                params,
             )
-            return int(cur.lastrowid)
-
-    def _task_from_row(self, r: sqlite3.Row) -> Task:
-        return Task(
-            id=r[0], user_id=r[1], text=r[2], raw_text=r[3], status=r[4],
-            due_at=r[5], created_at=r[6], updated_at=r[7],
-            source=r[8], source_agent=r[9], extra=self._loads_optional_json(r[10]),
-            calendar_id=r[11], calendar_event_id=r[12], calendar_event_etag=r[13],
-            google_updated_at=r[14], recurrence=r[15], person_id=r[16], notes=r[17],
-            last_modified=r[18],
-        )
+            # Под BEGIN IMMEDIATE других писателей нет, а AUTOINCREMENT выдаёт id подряд от
+            # max(sqlite_sequence, max(rowid)) + 1 — вставленные строки заканчиваются last_insert_rowid()
+            last = int(con.execute("SELECT last_insert_rowid();").fetchone()[0])
+        return list(range(last - len(params) + 1, last + 1))
+
+    def _task_from_row(self, r: Tuple[Any, ...]) -> Task:
+        # Порядок колонок _TASK_SELECT совпадает с полями Task — распаковка без поимённого перебора
+        return Task(*r)
 
     def get_task(self, task_id: int) -> Optional[Task]:
-        with self._connect() as con:
-            cur = con.cursor()
-            cur.execute(
-                """
-                SELECT
-                    id, user_id, text, raw_text, status, due_at, created_at, updated_at,
-                    source, source_agent, extra,
-                    calendar_id, calendar_event_id, calendar_event_etag, google_updated_at,
-                    recurrence, person_id, notes, last_modified
-                FROM tasks WHERE id=?;
-                """,
-                (task_id,),
-            )
-            r = cur.fetchone()
+        with self._for_read() as con:
+            r = con.execute(_SQL_SELECT_TASK_BY_ID, (task_id,)).fetchone()
             return self._task_from_row(r) if r else None
 
+    def get_tasks_by_ids(self, ids: Iterable[int]) -> Dict[int, Task]:
+        """
+        Пакетный get_task: {id: Task} одним запросом на каждые _IDS_CHUNK id.
+        Отсутствующие id в результат не попадают.
+        """
+        uniq = list(dict.fromkeys(int(i) for i in ids))
+        out: Dict[int, Task] = {}
+        if not uniq:
+            return out
+        with self._for_read() as con:
+            for i in range(0, len(uniq), _IDS_CHUNK):
+                chunk = uniq[i:i + _IDS_CHUNK]
+                for r in con.execute(_tasks_by_ids_sql(len(chunk)), chunk):
+                    t = self._task_from_row(r)
+                    out[t.id] = t
+        return out
+
+    def iter_tasks(
+        self,
+        user_id: Optional[int] = None,
+        *,
+        status: Optional[str] = None,
+        order_by: str = "due_at_nulls_last",
+        limit: Optional[int] = None,
+        offset: int = 0,
+    ) -> Iterator[Task]:
+        """
+        Потоковый вариант list_tasks: строки читаются из курсора по мере итерации,
+        без fetchall() и промежуточного списка. Соединение пула занято, пока генератор
+        не исчерпан или не закрыт — итерируйте до конца или вызывайте .close().
+        Без пула (:memory:, внутри transaction()) строки выбираются заранее — см. _iter_rows.
+        """
+        sql = _LIST_TASKS_SQL[
+            (user_id is not None, status is not None, order_by if order_by in _TASK_ORDER_SQL else "due_at_nulls_last")
+        ]
+        params: List[Any] = []
+        if user_id is not None:
+            params.append(user_id)
+        if status is not None:
+            params.append(status)
+        params.append(int(limit) if limit is not None else -1)
+        params.append(int(offset))
+        for r in self._iter_rows(sql, params):
+            yield self._task_from_row(r)
+
     def list_tasks(
         self,
         user_id: Optional[int] = None,
@@ -436,86 +1119,190 @@ class MemorySQLite:
         limit: Optional[int] = None,
         offset: int = 0,
     ) -> List[Task]:
-        with self._connect() as con:
-            cur = con.cursor()
-            clauses: List[str] = []
-            params: List[Any] = []
-            if user_id is not None:
-                clauses.append("user_id=?"); params.append(user_id)
-            if status is not None:
-                clauses.append("status=?"); params.append(status)
-            where = ("WHERE " + " AND ".join(clauses)) if clauses else ""
-            if order_by == "created_desc":
-                order_sql = "ORDER BY created_at DESC"
-            elif order_by == "updated_desc":
-                order_sql = "ORDER BY updated_at DESC"
-            else:
-                order_sql = "ORDER BY (due_at IS NULL), due_at ASC, id ASC"
-            lim = f" LIMIT {int(limit)}" if limit is not None else ""
-            off = f" OFFSET {int(offset)}" if offset else ""
-            cur.execute(
-                f"""
-                SELECT
-                    id, user_id, text, raw_text, status, due_at, created_at, updated_at,
-                    source, source_agent, extra,
-                    calendar_id, calendar_event_id, calendar_event_etag, google_updated_at,
-                    recurrence, person_id, notes, last_modified
-                FROM tasks {where} {order_sql} {lim}{off};
-                """,
-                params,
-            )
-            rows = cur.fetchall()
-            return [self._task_from_row(r) for r in rows]
+        return list(
+            self.iter_tasks(user_id, status=status, order_by=order_by, limit=limit, offset=offset)
+        )
+
+    def _task_update_sets(
+        self,
+        *,
+        text: Optional[str] = None,
+        raw_text: Optional[str] = _UNSET,
+        status: Optional[str] = None,
+        due_at: Optional[Union[int, float]] = _UNSET,
+        source: Optional[str] = _UNSET,
+        source_agent: Optional[str] = _UNSET,
+        extra: Optional[Dict[str, Any]] = _UNSET,
+        recurrence: Optional[str] = _UNSET,
+        person_id: Optional[int] = _UNSET,
+        notes: Optional[str] = _UNSET,
+        touch_last_modified: bool = True,
+    ) -> Tuple[Tuple[str, ...], List[Any]]:
+        """Изменяемые колонки (в фиксированном порядке) и их значения для _update_task_sql."""
+        sets: List[str] = []
+        params: List[Any] = []
+        # text/status — NOT NULL: None значит «не трогать»
+        if text is not None: sets.append("text"); params.append(text)
+        if status is not None: sets.append("status"); params.append(status)
+        # Nullable-поля: None — очистить (NULL); не передано (_UNSET) — не трогаем
+        if raw_text is not _UNSET: sets.append("raw_text"); params.append(raw_text)
+        if due_at is not _UNSET:
+            sets.append("due_at"); params.append(self._to_epoch(due_at))
+        if source is not _UNSET: sets.append("source"); params.append(source)
+        if source_agent is not _UNSET: sets.append("source_agent"); params.append(source_agent)
+        if extra is not _UNSET: sets.append("extra"); params.append(_json_param(extra))
+        if recurrence is not _UNSET: sets.append("recurrence"); params.append(recurrence)
+        if person_id is not _UNSET: sets.append("person_id"); params.append(person_id)
+        if notes is not _UNSET: sets.append("notes"); params.append(notes)
+
+        # Один замер времени на обе метки: updated_at и last_modified совпадают
+        now = self._now_epoch()
+        sets.append("updated_at"); params.append(now)
+        if touch_last_modified:
+            sets.append("last_modified"); params.append(now)
+        return tuple(sets), params
+
+    def _dirty_task_update(
+        self, con: sqlite3.Connection, task_id: int, cols: Tuple[str, ...], params: List[Any]
+    ) -> Optional[Tuple[Tuple[str, ...], List[Any]]]:
+        """
+        Оставляет в UPDATE только колонки, значение которых реально меняется (+ метки времени):
+        неизменённые поля не переписывают строку и не трогают индексы.
+        None — задачи нет; пустой набор колонок — менять нечего.
+        """
+        data = [(c, v) for c, v in zip(cols, params) if c not in _TOUCH_COLS]
+        if not data:
+            return cols, params
+        row = con.execute(_select_task_cols_sql(tuple(c for c, _ in data)), (task_id,)).fetchone()
+        if row is None:
+            return None
+        changed = [(c, v) for (c, v), old in zip(data, row) if not _same_value(c, v, old)]
+        if not changed:
+            return (), []
+        keep = changed + [(c, v) for c, v in zip(cols, params) if c in _TOUCH_COLS]
+        return tuple(c for c, _ in keep), [v for _, v in keep]
 
     def update_task(
         self,
         task_id: int,
         *,
         text: Optional[str] = None,
-        raw_text: Optional[str] = None,
+        raw_text: Optional[str] = _UNSET,
         status: Optional[str] = None,
-        due_at: Optional[Union[int, float, None]] = None,
+        due_at: Optional[Union[int, float]] = _UNSET,
+        source: Optional[str] = _UNSET,
+        source_agent: Optional[str] = _UNSET,
+        extra: Optional[Dict[str, Any]] = _UNSET,
+        recurrence: Optional[str] = _UNSET,
+        person_id: Optional[int] = _UNSET,
+        notes: Optional[str] = _UNSET,
+        touch_last_modified: bool = True,
+    ) -> bool:
+        sets, params = self._task_update_sets(
+            text=text, raw_text=raw_text, status=status, due_at=due_at,
+            source=source, source_agent=source_agent, extra=extra,
+            recurrence=recurrence, person_id=person_id, notes=notes,
+            touch_last_modified=touch_last_modified,
+        )
+        with self._for_write() as con:
+            dirty = self._dirty_task_update(con, task_id, sets, params)
+            if dirty is None:
+                return False
+            sets, params = dirty
+            if not sets:
+                return True  # значения уже такие — ни записи, ни сдвига updated_at/last_modified
+            params.append(task_id)
+            cur = con.cursor()
+            cur.execute(_update_task_sql(sets), params)
+            return cur.rowcount > 0
+
+    def update_task_returning(self, task_id: int, **fields: Any) -> Optional[Task]:
+        """
+        Как update_task (те же именованные аргументы), но возвращает обновлённую задачу
+        из UPDATE ... RETURNING — без отдельного get_task. None — задачи с таким id нет.
+        """
+        sets, params = self._task_update_sets(**fields)
+        with self._for_write() as con:
+            dirty = self._dirty_task_update(con, task_id, sets, params)
+            if dirty is None:
+                return None
+            sets, params = dirty
+            if not sets:
+                r = con.execute(_SQL_SELECT_TASK_BY_ID, (task_id,)).fetchone()
+                return self._task_from_row(r) if r else None
+            params.append(task_id)
+            if _HAS_RETURNING:
+                r = con.execute(_update_task_sql(sets, returning=True), params).fetchone()
+                return self._task_from_row(r) if r else None
+            if con.execute(_update_task_sql(sets), params).rowcount == 0:
+                return None
+            r = con.execute(_SQL_SELECT_TASK_BY_ID, (task_id,)).fetchone()
+            return self._task_from_row(r)
+
+    def upsert_task(
+        self,
+        task_id: Optional[int],
+        user_id: int,
+        text: str,
+        *,
+        raw_text: Optional[str] = None,
+        due_at: Optional[Union[int, float]] = None,
+        status: str = "open",
         source: Optional[str] = None,
         source_agent: Optional[str] = None,
         extra: Optional[Dict[str, Any]] = None,
         recurrence: Optional[str] = None,
         person_id: Optional[int] = None,
         notes: Optional[str] = None,
-        touch_last_modified: bool = True,
-    ) -> bool:
-        sets: List[str] = []
-        params: List[Any] = []
-        if text is not None: sets.append("text=?"); params.append(text)
-        if raw_text is not None: sets.append("raw_text=?"); params.append(raw_text)
-        if status is not None: sets.append("status=?"); params.append(status)
-        if due_at is not None or due_at is None:
-            sets.append("due_at=?"); params.append(self._to_epoch(due_at))
-        if source is not None: sets.append("source=?"); params.append(source)
-        if source_agent is not None: sets.append("source_agent=?"); params.append(source_agent)
-        if extra is not None: sets.append("extra=?"); params.append(self._dumps_optional_json(extra))
-        if recurrence is not None: sets.append("recurrence=?"); params.append(recurrence)
-        if person_id is not None: sets.append("person_id=?"); params.append(person_id)
-        if notes is not None: sets.append("notes=?"); params.append(notes)
-
-        sets.append("updated_at=?"); params.append(self._now_epoch())
-        if touch_last_modified:
-            sets.append("last_modified=?"); params.append(self._now_epoch())
-
-        params.append(task_id)
-        if not sets:
-            return False
-        with self._connect() as con:
+    ) -> int:
+        """
+        Вставить задачу или перезаписать существующую с тем же id — один statement
+        (INSERT ... ON CONFLICT(id) DO UPDATE) вместо get_task + add_task/update_task.
+        task_id=None — всегда новая задача. created_at и календарные поля при обновлении сохраняются.
+        """
+        now = self._now_epoch()
+        with self._for_write() as con:
             cur = con.cursor()
-            cur.execute(f"UPDATE tasks SET {', '.join(sets)} WHERE id=?;", params)
-            return cur.rowcount > 0
+            cur.execute(
+                f"""
+                INSERT INTO tasks (
+                    id, user_id, text, raw_text, status, due_at, created_at, updated_at,
+                    source, source_agent, extra, recurrence, person_id, notes, last_modified
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    user_id=excluded.user_id,
+                    text=excluded.text,
+                    raw_text=excluded.raw_text,
+                    status=excluded.status,
+                    due_at=excluded.due_at,
+                    updated_at=excluded.updated_at,
+                    source=excluded.source,
+                    source_agent=excluded.source_agent,
+                    extra=excluded.extra,
+                    recurrence=excluded.recurrence,
+                    person_id=excluded.person_id,
+                    notes=excluded.notes,
+                    last_modified=excluded.last_modified{_RETURNING_ID};
+                """,
+                (
+                    task_id, user_id, text, raw_text, status, self._to_epoch(due_at), now, now,
+                    source, source_agent, _json_param(extra),
+                    recurrence, person_id, notes, now,
+                ),
+            )
+            if not _HAS_RETURNING:
+                # lastrowid после ON CONFLICT DO UPDATE не определён — id известен заранее
+                return int(task_id if task_id is not None else cur.lastrowid)
+            return int(cur.fetchone()[0])
 
     def delete_task(self, task_id: int) -> bool:
-        with self._connect() as con:
+        with self._for_write() as con:
             cur = con.cursor()
             cur.execute("DELETE FROM tasks WHERE id=?;", (task_id,))
             return cur.rowcount > 0
 
-    def list_upcoming_tasks(
+    def iter_upcoming_tasks(
         self,
         *,
         user_id: Optional[int] = None,
@@ -523,32 +1310,70 @@ class MemorySQLite:
         due_to: Optional[Union[int, float]] = None,
         status: str = "open",
         limit: Optional[int] = None,
-    ) -> List[Task]:
-        df = self._to_epoch(due_from) or self._now_epoch()
+    ) -> Iterator[Task]:
+        """Потоковый list_upcoming_tasks (см. iter_tasks про время жизни генератора)."""
+        # 0 — валидная нижняя граница (дайджест просроченных), «сейчас» — только если её нет
+        df = self._to_epoch(due_from) if due_from is not None else None
+        if df is None:
+            df = self._now_epoch()
         dt = self._to_epoch(due_to)
-        clauses = ["status=?", "due_at IS NOT NULL", "due_at >= ?"]
         params: List[Any] = [status, df]
         if dt is not None:
-            clauses.append("due_at <= ?"); params.append(dt)
+            params.append(dt)
         if user_id is not None:
-            clauses.append("user_id=?"); params.append(user_id)
-        where = "WHERE " + " AND ".join(clauses)
-        lim = f" LIMIT {int(limit)}" if limit is not None else ""
-        with self._connect() as con:
-            cur = con.cursor()
-            cur.execute(
-                f"""
-                SELECT
-                    id, user_id, text, raw_text, status, due_at, created_at, updated_at,
-                    source, source_agent, extra,
-                    calendar_id, calendar_event_id, calendar_event_etag, google_updated_at,
-                    recurrence, person_id, notes, last_modified
-                FROM tasks {where} ORDER BY due_at ASC, id ASC {lim};
-                """,
-                params,
+            params.append(user_id)
+        params.append(int(limit) if limit is not None else -1)
+        for r in self._iter_rows(_UPCOMING_TASKS_SQL[(dt is not None, user_id is not None)], params):
+            yield self._task_from_row(r)
+
+    def list_upcoming_tasks(
+        self,
+        *,
+        user_id: Optional[int] = None,
+        due_from: Optional[Union[int, float]] = None,
+        due_to: Optional[Union[int, float]] = None,
+        status: str = "open",
+        limit: Optional[int] = None,
+    ) -> List[Task]:
+        return list(
+            self.iter_upcoming_tasks(
+                user_id=user_id, due_from=due_from, due_to=due_to, status=status, limit=limit
             )
-            rows = cur.fetchall()
-            return [self._task_from_row(r) for r in rows]
+        )
+
+    def list_task_ids_due_between(
+        self,
+        due_from: Union[int, float],
+        due_to: Union[int, float],
+        *,
+        user_id: Optional[int] = None,
+        status: str = "open",
+    ) -> List[int]:
+        """Только id задач со сроком в [due_from, due_to] — без сборки Task и JSON extra."""
+        params: List[Any] = [status, self._to_epoch(due_from), self._to_epoch(due_to)]
+        if user_id is not None:
+            params.append(user_id)
+        with self._for_read() as con:
+            cur = con.execute(_TASK_IDS_DUE_BETWEEN_SQL[user_id is not None], params)
+            return [r[0] for r in cur]
+
+    def iter_task_columns(
+        self,
+        columns: Tuple[str, ...] = ("id", "due_at"),
+        *,
+        user_id: Optional[int] = None,
+        status: Optional[str] = None,
+    ) -> Iterator[sqlite3.Row]:
+        """
+        Узкий потоковый SELECT: только нужные колонки (sqlite3.Row, доступ по индексу/имени)
+        вместо полного Task. Колонки — подмножество _TASK_COLS.
+        """
+        unknown = [c for c in columns if c not in _TASK_COLS]
+        if not columns or unknown:
+            raise ValueError(f"Unknown task columns: {unknown or columns}")
+        params = [v for v in (user_id, status) if v is not None]
+        sql = _task_columns_sql(tuple(columns), user_id is not None, status is not None)
+        yield from self._iter_rows(sql, params, row_factory=sqlite3.Row)
 
     # -------------------
     # Calendar linking & sync helpers
@@ -579,13 +1404,13 @@ class MemorySQLite:
         ]
         sql = f"UPDATE tasks SET {', '.join(sets)} WHERE id=?;"
         params.append(task_id)
-        with self._connect() as con:
+        with self._for_write() as con:
             cur = con.cursor()
             cur.execute(sql, params)
             return cur.rowcount > 0
 
     def clear_task_calendar_link(self, task_id: int) -> bool:
-        with self._connect() as con:
+        with self._for_write() as con:
             cur = con.cursor()
             cur.execute(
                 """
@@ -598,70 +1423,147 @@ class MemorySQLite:
             )
             return cur.rowcount > 0
 
+    def upsert_task_by_calendar_event(
+        self,
+        user_id: int,
+        calendar_id: str,
+        event_id: str,
+        text: str,
+        *,
+        event_etag: Optional[str] = None,
+        google_updated_at: Optional[Union[int, float]] = None,
+        raw_text: Optional[str] = None,
+        due_at: Optional[Union[int, float]] = None,
+        status: str = "open",
+        source: Optional[str] = None,
+        source_agent: Optional[str] = None,
+        extra: Optional[Dict[str, Any]] = None,
+        recurrence: Optional[str] = None,
+        person_id: Optional[int] = None,
+        notes: Optional[str] = None,
+    ) -> int:
+        """
+        Синк из календаря одним statement'ом вместо get_task_by_calendar_event + add_task/update_task:
+        INSERT ... ON CONFLICT(user_id, calendar_id, calendar_event_id) DO UPDATE ... RETURNING id.
+        Если etag передан и не изменился — строка не перезаписывается. Возвращает id задачи.
+        """
+        now = self._now_epoch()
+        values = {
+            "user_id": user_id, "calendar_id": calendar_id, "calendar_event_id": event_id,
+            "calendar_event_etag": event_etag, "google_updated_at": self._to_epoch(google_updated_at),
+            "text": text, "raw_text": raw_text, "status": status, "due_at": self._to_epoch(due_at),
+            "source": source, "source_agent": source_agent, "extra": _json_param(extra),
+            "recurrence": recurrence, "person_id": person_id, "notes": notes,
+            "created_at": now, "updated_at": now, "last_modified": now,
+        }
+        cols = ", ".join(values)
+        marks = ", ".join("?" * len(values))
+        with self.transaction() as con:
+            try:
+                r = con.execute(
+                    f"""
+                    INSERT INTO tasks ({cols}) VALUES ({marks})
+                    ON CONFLICT(user_id, calendar_id, calendar_event_id) WHERE calendar_event_id IS NOT NULL
+                    DO UPDATE SET
+                        calendar_event_etag=excluded.calendar_event_etag,
+                        google_updated_at=excluded.google_updated_at,
+                        text=excluded.text,
+                        raw_text=excluded.raw_text,
+                        status=excluded.status,
+                        due_at=excluded.due_at,
+                        source=excluded.source,
+                        source_agent=excluded.source_agent,
+                        extra=excluded.extra,
+                        recurrence=excluded.recurrence,
+                        person_id=excluded.person_id,
+                        notes=excluded.notes,
+                        updated_at=excluded.updated_at,
+                        last_modified=excluded.last_modified
+                    WHERE excluded.calendar_event_etag IS NULL
+                       OR tasks.calendar_event_etag IS NOT excluded.calendar_event_etag
+                    RETURNING id;
+                    """,
+                    list(values.values()),
+                ).fetchone()
+            except sqlite3.OperationalError:
+                # Нет idx_tasks_cal_unique (дубли в старой БД) или SQLite без RETURNING — по-старому
+                r = None
+                existing = self._find_task_id_by_calendar_event(con, user_id, calendar_id, event_id)
+                if existing is None:
+                    cur = con.execute(f"INSERT INTO tasks ({cols}) VALUES ({marks});", list(values.values()))
+                    return int(cur.lastrowid)
+                for key in ("user_id", "calendar_id", "calendar_event_id", "created_at"):
+                    values.pop(key)
+                con.execute(
+                    f"UPDATE tasks SET {', '.join(f'{k}=?' for k in values)} WHERE id=? "
+                    "AND (? IS NULL OR calendar_event_etag IS NOT ?);",
+                    [*values.values(), existing, event_etag, event_etag],
+                )
+                return existing
+            if r is not None:
+                return int(r[0])
+            # etag не изменился: DO UPDATE ... WHERE отфильтровал строку, RETURNING пуст
+            return self._find_task_id_by_calendar_event(con, user_id, calendar_id, event_id)
+
+    @staticmethod
+    def _find_task_id_by_calendar_event(
+        con: sqlite3.Connection, user_id: int, calendar_id: str, event_id: str
+    ) -> Optional[int]:
+        r = con.execute(
+            "SELECT id FROM tasks WHERE user_id=? AND calendar_id=? AND calendar_event_id=? LIMIT 1;",
+            (user_id, calendar_id, event_id),
+        ).fetchone()
+        return int(r[0]) if r else None
+
     def get_task_by_calendar_event(
         self, user_id: int, calendar_id: str, event_id: str
     ) -> Optional[Task]:
-        with self._connect() as con:
-            cur = con.cursor()
-            cur.execute(
-                """
-                SELECT
-                    id, user_id, text, raw_text, status, due_at, created_at, updated_at,
-                    source, source_agent, extra,
-                    calendar_id, calendar_event_id, calendar_event_etag, google_updated_at,
-                    recurrence, person_id, notes, last_modified
-                FROM tasks
-                WHERE user_id=? AND calendar_id=? AND calendar_event_id=?
-                LIMIT 1;
-                """,
-                (user_id, calendar_id, event_id),
-            )
-            r = cur.fetchone()
+        with self._for_read() as con:
+            r = con.execute(_SQL_SELECT_TASK_BY_CAL_EVENT, (user_id, calendar_id, event_id)).fetchone()
             return self._task_from_row(r) if r else None
 
+    def iter_tasks_missing_calendar_link(self, user_id: int) -> Iterator[Task]:
+        for r in self._iter_rows(_SQL_TASKS_MISSING_LINK, (user_id,)):
+            yield self._task_from_row(r)
+
     def list_tasks_missing_calendar_link(self, user_id: int) -> List[Task]:
-        with self._connect() as con:
-            cur = con.cursor()
-            cur.execute(
-                """
-                SELECT
-                    id, user_id, text, raw_text, status, due_at, created_at, updated_at,
-                    source, source_agent, extra,
-                    calendar_id, calendar_event_id, calendar_event_etag, google_updated_at,
-                    recurrence, person_id, notes, last_modified
-                FROM tasks
-                WHERE user_id=? AND calendar_event_id IS NULL AND status='open';
-                """,
-                (user_id,),
-            )
-            return [self._task_from_row(r) for r in cur.fetchall()]
+        return list(self.iter_tasks_missing_calendar_link(user_id))
+
+    def iter_tasks_modified_since(self, ts_epoch: int, user_id: Optional[int] = None) -> Iterator[Task]:
+        params: List[Any] = [int(ts_epoch)]
+        if user_id is not None:
+            params.append(user_id)
+        for r in self._iter_rows(_TASKS_MODIFIED_SINCE_SQL[user_id is not None], params):
+            yield self._task_from_row(r)
 
     def list_tasks_modified_since(self, ts_epoch: int, user_id: Optional[int] = None) -> List[Task]:
-        with self._connect() as con:
-            cur = con.cursor()
-            clauses = ["last_modified > ?"]
-            params: List[Any] = [int(ts_epoch)]
-            if user_id is not None:
-                clauses.append("user_id=?"); params.append(user_id)
-            where = "WHERE " + " AND ".join(clauses)
-            cur.execute(
-                f"""
-                SELECT
-                    id, user_id, text, raw_text, status, due_at, created_at, updated_at,
-                    source, source_agent, extra,
-                    calendar_id, calendar_event_id, calendar_event_etag, google_updated_at,
-                    recurrence, person_id, notes, last_modified
-                FROM tasks
-                {where}
-                ORDER BY last_modified ASC;
-                """,
-                params,
-            )
-            return [self._task_from_row(r) for r in cur.fetchall()]
+        return list(self.iter_tasks_modified_since(ts_epoch, user_id))
+
+    def iter_tasks_by_extra_field(
+        self, key: str, value: Union[str, int, float], *, user_id: Optional[int] = None
+    ) -> Iterator[Task]:
+        """
+        Задачи, у которых extra[key] == value (скалярное значение верхнего уровня).
+        Сравнение выполняет SQLite (json_extract) — в Python приходят только подходящие строки.
+        """
+        if '"' in key:
+            # JSON-путь SQLite не умеет экранировать кавычку внутри имени ключа
+            raise ValueError(f"Unsupported extra key: {key!r}")
+        path = f'$."{key}"'
+        params: List[Any] = [path, value]
+        if user_id is not None:
+            params.append(user_id)
+        for r in self._iter_rows(_TASKS_BY_EXTRA_SQL[user_id is not None], params):
+            yield self._task_from_row(r)
+
+    def list_tasks_by_extra_field(
+        self, key: str, value: Union[str, int, float], *, user_id: Optional[int] = None
+    ) -> List[Task]:
+        return list(self.iter_tasks_by_extra_field(key, value, user_id=user_id))
 
     def mark_task_locally_modified(self, task_id: int) -> bool:
         now = self._now_epoch()
-        with self._connect() as con:
+        with self._for_write() as con:
             cur = con.cursor()
             cur.execute(
                 "UPDATE tasks SET updated_at=?, last_modified=? WHERE id=?;",
@@ -684,35 +1586,67 @@ class MemorySQLite:
         extra: Optional[Dict[str, Any]] = None,
     ) -> int:
         created = updated = self._now_epoch()
-        extra_json = self._dumps_optional_json(extra)
-        with self._connect() as con:
+        with self._for_write() as con:
             cur = con.cursor()
             cur.execute(
-                """
+                f"""
                 INSERT INTO notes (user_id, text, raw_text, created_at, updated_at, source, source_agent, extra)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?){_RETURNING_ID};
                 """,
-                (user_id, text, raw_text, created, updated, source, source_agent, extra_json),
+                (user_id, text, raw_text, created, updated, source, source_agent, _json_param(extra)),
             )
-            return int(cur.lastrowid)
+            return self._inserted_id(cur)
 
-    def get_note(self, note_id: int) -> Optional[Note]:
-        with self._connect() as con:
-            cur = con.cursor()
-            cur.execute(
+    def add_notes_bulk(self, rows: List[Dict[str, Any]]) -> List[int]:
+        """Массовая вставка заметок — как add_tasks_bulk. Ключи — как у аргументов add_note."""
+        if not rows:
+            return []
+        now = self._now_epoch()
+        params = [
+            (
+                r["user_id"], r["text"], r.get("raw_text"), now, now,
+                r.get("source"), r.get("source_agent"), _json_param(r.get("extra")),
+            )
+            for r in rows
+        ]
+        with self.transaction() as con:
+            con.executemany(
                 """
-                SELECT id, user_id, text, raw_text, created_at, updated_at, source, source_agent, extra
-                FROM notes WHERE id=?;
+                INSERT INTO notes (user_id, text, raw_text, created_at, updated_at, source, source_agent, extra)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?);
                 """,
-                (note_id,),
+                params,
             )
-            r = cur.fetchone()
+            last = int(con.execute("SELECT last_insert_rowid();").fetchone()[0])
+        return list(range(last - len(params) + 1, last + 1))
+
+    def get_note(self, note_id: int) -> Optional[Note]:
+        with self._for_read() as con:
+            r = con.execute(_SQL_SELECT_NOTE_BY_ID, (note_id,)).fetchone()
             if not r:
                 return None
             return Note(
                 id=r[0], user_id=r[1], text=r[2], raw_text=r[3],
                 created_at=r[4], updated_at=r[5], source=r[6],
-                source_agent=r[7], extra=self._loads_optional_json(r[8]),
+                source_agent=r[7], extra=r[8],
+            )
+
+    def iter_notes(
+        self,
+        user_id: Optional[int] = None,
+        *,
+        order_by: str = "created_desc",
+        limit: Optional[int] = None,
+        offset: int = 0,
+    ) -> Iterator[Note]:
+        params: List[Any] = [] if user_id is None else [user_id]
+        params.append(int(limit) if limit is not None else -1)
+        params.append(int(offset))
+        for r in self._iter_rows(_LIST_NOTES_SQL[(user_id is not None, order_by == "created_desc")], params):
+            yield Note(
+                id=r[0], user_id=r[1], text=r[2], raw_text=r[3],
+                created_at=r[4], updated_at=r[5], source=r[6],
+                source_agent=r[7], extra=r[8],
             )
 
     def list_notes(
@@ -723,34 +1657,10 @@ class MemorySQLite:
         limit: Optional[int] = None,
         offset: int = 0,
     ) -> List[Note]:
-        with self._connect() as con:
-            cur = con.cursor()
-            clauses = []; params: List[Any] = []
-            if user_id is not None:
-                clauses.append("user_id=?"); params.append(user_id)
-            where = ("WHERE " + " AND ".join(clauses)) if clauses else ""
-            order_sql = "ORDER BY created_at DESC" if order_by == "created_desc" else "ORDER BY id ASC"
-            lim = f" LIMIT {int(limit)}" if limit is not None else ""
-            off = f" OFFSET {int(offset)}" if offset else ""
-            cur.execute(
-                f"""
-                SELECT id, user_id, text, raw_text, created_at, updated_at, source, source_agent, extra
-                FROM notes {where} {order_sql} {lim}{off};
-                """,
-                params,
-            )
-            rows = cur.fetchall()
-            return [
-                Note(
-                    id=r[0], user_id=r[1], text=r[2], raw_text=r[3],
-                    created_at=r[4], updated_at=r[5], source=r[6],
-                    source_agent=r[7], extra=self._loads_optional_json(r[8]),
-                )
-                for r in rows
-            ]
+        return list(self.iter_notes(user_id, order_by=order_by, limit=limit, offset=offset))
 
     def delete_note(self, note_id: int) -> bool:
-        with self._connect() as con:
+        with self._for_write() as con:
             cur = con.cursor()
             cur.execute("DELETE FROM notes WHERE id=?;", (note_id,))
             return cur.rowcount > 0
@@ -767,18 +1677,29 @@ class MemorySQLite:
         *,
         expiry: Optional[Union[int, float]] = None,
         scopes: Optional[List[str]] = None,
+        skip_if_same: bool = True,
     ) -> None:
         """
         Сохраняет OAuth-токен в таблицу oauth_tokens.
         token_json хранится в зашифрованном виде (через encrypt_dict).
+        skip_if_same: если сохранённый токен уже такой же (token_json, expiry, scopes) — ни
+        шифрования, ни записи. False — перезаписать всё равно (например, перешифровать новым ключом).
         """
-        now = self._now_epoch()
+        expiry_epoch = self._to_epoch(expiry)
         scopes_str = ",".join(scopes) if scopes else None
+        if skip_if_same:
+            # Шифротекст каждый раз разный (случайный IV) — сравниваем расшифрованный токен (обычно из кэша)
+            current = self._shared_oauth_token(user_id, provider)
+            if current is not None and (current.token_json, current.expiry, current.scopes) == (
+                token_json, expiry_epoch, scopes_str,
+            ):
+                return
+        now = self._now_epoch()
 
         # 🔒 Шифруем dict → строка
         token_blob = encrypt_dict(token_json)
 
-        with self._connect() as con:
+        with self._for_write() as con:
             cur = con.cursor()
             cur.execute(
                 """
@@ -790,15 +1711,45 @@ class MemorySQLite:
                     scopes=excluded.scopes,
                     updated_at=excluded.updated_at;
                 """,
-                (user_id, provider, token_blob, self._to_epoch(expiry), scopes_str, now, now),
+                (user_id, provider, token_blob, expiry_epoch, scopes_str, now, now),
             )
+        self._invalidate_token(user_id, provider)
 
     def get_oauth_token(self, user_id: str, provider: str) -> Optional[OAuthToken]:
         """
         Читает OAuth-токен из oauth_tokens и расшифровывает поле token_json.
         Старые записи с обычным JSON тоже корректно прочитаются (decrypt_dict сам разрулит).
+        Результат кэшируется на TOKEN_CACHE_TTL секунд; upsert/delete кэш сбрасывают.
         """
-        with self._connect() as con:
+        return self._copy_token(self._shared_oauth_token(user_id, provider))
+
+    def _shared_oauth_token(self, user_id: str, provider: str) -> Optional[OAuthToken]:
+        # Экземпляр из кэша (или свежепрочитанный и закэшированный) — наружу только через _copy_token
+        key = (user_id, provider)
+        with self._token_cache_lock:
+            hit = self._token_cache.get(key)
+            gen = self._token_cache_gen
+        if hit is not None and time.monotonic() - hit[0] < TOKEN_CACHE_TTL:
+            return hit[1]
+        token = self._read_oauth_token(user_id, provider)
+        with self._token_cache_lock:
+            if gen == self._token_cache_gen:
+                self._token_cache[key] = (time.monotonic(), token)
+        return token
+
+    @staticmethod
+    def _copy_token(token: Optional[OAuthToken]) -> Optional[OAuthToken]:
+        # Вызывающий может менять token_json, в т.ч. вложенные списки (scopes) — наружу отдаём
+        # полную копию, кэшированный экземпляр и его вложенные объекты не разделяются
+        return copy.deepcopy(token)
+
+    def _invalidate_token(self, user_id: str, provider: str) -> None:
+        with self._token_cache_lock:
+            self._token_cache_gen += 1
+            self._token_cache.pop((user_id, provider), None)
+
+    def _read_oauth_token(self, user_id: str, provider: str) -> Optional[OAuthToken]:
+        with self._for_read() as con:
             cur = con.cursor()
             cur.execute(
                 """
@@ -828,10 +1779,11 @@ class MemorySQLite:
 
 
     def delete_oauth_token(self, user_id: str, provider: str) -> bool:
-        with self._connect() as con:
+        with self._for_write() as con:
             cur = con.cursor()
             cur.execute("DELETE FROM oauth_tokens WHERE user_id=? AND provider=?;", (user_id, provider))
-            return cur.rowcount > 0
+        self._invalidate_token(user_id, provider)
+        return cur.rowcount > 0
 
     # -------------------
     # Conversational Memory (messages + summary)
@@ -848,17 +1800,57 @@ class MemorySQLite:
     ) -> int:
         now = self._now_epoch()
         ts = self._to_epoch(ts_epoch) or now
-        meta_blob = self._dumps_optional_json(meta_json)
-        with self._connect() as con:
+        with self._for_write() as con:
             cur = con.cursor()
             cur.execute(
+                f"""
+                INSERT INTO conversation_memory (user_id, role, content, meta_json, ts_epoch, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?){_RETURNING_ID};
+                """,
+                (user_id, role, content, _json_param(meta_json), ts, now, now),
+            )
+            return self._inserted_id(cur)
+
+    def add_conversation_messages_bulk(self, rows: List[Dict[str, Any]]) -> List[int]:
+        """
+        Пачка сообщений одним executemany в одной транзакции (один коммит на пачку).
+        Ключи — как у аргументов add_conversation_message. Возвращает id в порядке rows.
+        """
+        if not rows:
+            return []
+        now = self._now_epoch()
+        params = [
+            (
+                r["user_id"], r["role"], r["content"], _json_param(r.get("meta_json")),
+                self._to_epoch(r.get("ts_epoch")) or now, now, now,
+            )
+            for r in rows
+        ]
+        with self.transaction() as con:
+            con.executemany(
                 """
                 INSERT INTO conversation_memory (user_id, role, content, meta_json, ts_epoch, created_at, updated_at)
                 VALUES (?, ?, ?, ?, ?, ?, ?);
                 """,
-                (user_id, role, content, meta_blob, ts, now, now),
+                params,
             )
-            return int(cur.lastrowid)
+            last = int(con.execute("SELECT last_insert_rowid();").fetchone()[0])
+        return list(range(last - len(params) + 1, last + 1))
+
+    def iter_conversation_messages(
+        self,
+        user_id: int,
+        *,
+        limit: int = 50,
+        offset: int = 0,
+        roles: Optional[List[str]] = None,
+        order: str = "asc",  # 'asc' | 'desc' по ts_epoch
+    ) -> Iterator[ConversationMessage]:
+        """Потоковое чтение истории: строки идут из курсора по одной, без fetchall()."""
+        roles = list(roles or ())
+        sql = _conversation_messages_sql(len(roles), order.lower() != "asc")
+        for r in self._iter_rows(sql, (user_id, *roles, int(limit), int(offset))):
+            yield ConversationMessage(*r)
 
     def list_conversation_messages(
         self,
@@ -869,36 +1861,35 @@ class MemorySQLite:
         roles: Optional[List[str]] = None,
         order: str = "asc",  # 'asc' | 'desc' по ts_epoch
     ) -> List[ConversationMessage]:
-        order_sql = "ASC" if order.lower() == "asc" else "DESC"
-        with self._connect() as con:
-            cur = con.cursor()
-            clauses = ["user_id=?"]
-            params: List[Any] = [user_id]
-            if roles:
-                placeholders = ",".join("?" for _ in roles)
-                clauses.append(f"role IN ({placeholders})")
-                params.extend(roles)
-            where = "WHERE " + " AND ".join(clauses)
-            cur.execute(
-                f"""
-                SELECT id, user_id, role, content, meta_json, ts_epoch, created_at, updated_at
-                FROM conversation_memory
-                {where}
-                ORDER BY ts_epoch {order_sql}
-                LIMIT ? OFFSET ?;
-                """,
-                (*params, int(limit), int(offset)),
-            )
-            rows = cur.fetchall()
+        return list(
+            self.iter_conversation_messages(user_id, limit=limit, offset=offset, roles=roles, order=order)
+        )
+
+    def search_conversation_messages(self, user_id: int, query: str, *, limit: int = 20) -> List[ConversationMessage]:
+        """
+        Поиск по тексту истории пользователя (сначала новые): каждое слово query должно быть
+        началом какого-то слова сообщения, без учёта регистра ("молок" находит "молоко").
+        С FTS5 — префиксный запрос по индексу conversation_fts, без него — перебор сообщений
+        пользователя с той же разбивкой на слова. Разница одна: токенизатор unicode61
+        ещё и снимает диакритику ("cafe" найдёт "café"), перебор сравнивает буквы как есть.
+        """
+        words = _SEARCH_WORD_RE.findall(query.casefold())
+        if not words:
+            return []
+        with self._for_read() as con:
+            if self._has_fts:
+                # Каждое слово — строка FTS в кавычках (ввод не трактуется как синтаксис MATCH) + * для префикса
+                match = " ".join('"' + w + '"*' for w in words)
+                rows = con.execute(_SQL_SEARCH_CONVERSATION_FTS, (match, user_id, int(limit))).fetchall()
+                return [ConversationMessage(*r) for r in rows]
+            # lower() в SQLite — только ASCII, поэтому слова и регистр разбираем в Python
             out: List[ConversationMessage] = []
-            for r in rows:
-                out.append(
-                    ConversationMessage(
-                        id=r[0], user_id=r[1], role=r[2], content=r[3],
-                        meta_json=self._loads_optional_json(r[4]),
-                        ts_epoch=r[5], created_at=r[6], updated_at=r[7],
-                    )
-                )
+            for r in con.execute(_SQL_SEARCH_CONVERSATION_SCAN, (user_id,)):
+                tokens = _SEARCH_WORD_RE.findall(r[3].casefold())
+                if all(any(t.startswith(w) for t in tokens) for w in words):
+                    out.append(ConversationMessage(*r))
+                    if len(out) >= limit:
+                        break
             return out
 
     def prune_conversation_history(self, user_id: int, keep_last: int = 50) -> int:
@@ -906,35 +1897,16 @@ class MemorySQLite:
         Оставить только последние keep_last сообщений по ts_epoch.
         Возвращает количество удалённых строк.
         """
-        with self._connect() as con:
-            cur = con.cursor()
-            # Найти порог ts по смещению
-            cur.execute(
-                """
-                SELECT ts_epoch FROM conversation_memory
-                WHERE user_id=?
-                ORDER BY ts_epoch DESC
-                LIMIT 1 OFFSET ?;
-                """,
-                (user_id, max(keep_last - 1, 0)),
-            )
-            row = cur.fetchone()
-            if not row:
-                return 0  # ничего не удаляем
-
-            threshold_ts = row[0]
-            cur.execute(
-                """
-                DELETE FROM conversation_memory
-                WHERE user_id=? AND ts_epoch < ?;
-                """,
-                (user_id, threshold_ts),
-            )
+        with self._for_write() as con:
+            # Один statement: порог ts — keep_last-е сообщение с конца (подзапрос идёт по покрывающему
+            # idx_cm_user_ts и просматривает только keep_last записей индекса). Сообщений меньше —
+            # подзапрос даёт NULL, сравнение ложно, ничего не удаляется.
+            cur = con.execute(_SQL_PRUNE_CONVERSATION, (user_id, user_id, max(keep_last - 1, 0)))
             return cur.rowcount or 0
 
     def set_conversation_summary(self, user_id: int, summary_text: str) -> None:
         now = self._now_epoch()
-        with self._connect() as con:
+        with self._for_write() as con:
             cur = con.cursor()
             cur.execute(
                 """
@@ -948,7 +1920,7 @@ class MemorySQLite:
             )
 
     def get_conversation_summary(self, user_id: int) -> Optional[ConversationSummary]:
-        with self._connect() as con:
+        with self._for_read() as con:
             cur = con.cursor()
             cur.execute(
                 """
@@ -971,7 +1943,7 @@ class MemorySQLite:
         Возвращает количество удалённых сообщений (summary удаляется отдельно).
         """
         deleted = 0
-        with self._connect() as con:
+        with self._for_write() as con:
             cur = con.cursor()
             cur.execute("DELETE FROM conversation_memory WHERE user_id=?;", (user_id,))
             deleted = cur.rowcount or 0
@@ -983,19 +1955,101 @@ class MemorySQLite:
     # -------------------
 
     def reset_db(self) -> None:
-        with self._connect() as con:
-            cur = con.cursor()
-            cur.execute("DROP TABLE IF EXISTS tasks;")
-            cur.execute("DROP TABLE IF EXISTS notes;")
-            cur.execute("DROP TABLE IF EXISTS oauth_tokens;")
-            cur.execute("DROP TABLE IF EXISTS conversation_memory;")
-            cur.execute("DROP TABLE IF EXISTS conversation_summary;")
-            cur.execute("DROP TABLE IF EXISTS schema_version;")
-            con.execute("VACUUM;")
-        self.init_db()
+        with self._token_cache_lock:
+            self._token_cache_gen += 1
+            self._token_cache.clear()
+        if self._in_memory:
+            # :memory: всегда создана текущим кодом — схему не пересоздаём, просто очищаем данные
+            with self._for_write() as con:
+                cur = con.cursor()
+                for table in ("tasks", "notes", "oauth_tokens", "conversation_memory", "conversation_summary"):
+                    cur.execute(f"DELETE FROM {table};")
+            return
+        # Файловая БД: «начать с нуля» = удалить файл (O(1)) вместо DROP + VACUUM (копия всех страниц).
+        # Читатели, занятые в этот момент (недочитанный iter_*), дочитывают старый снимок и
+        # закрываются при возврате — в новый пул не попадают (_release_reader).
+        with self._write_lock:
+            self._close_readers()
+            self._writer.close()
+            try:
+                for suffix in ("", "-wal", "-shm"):
+                    Path(self.db_path + suffix).unlink(missing_ok=True)
+            except PermissionError:
+                # Windows: открытый файл не удалить, пока его держит занятый читатель —
+                # очищаем схему внутри того же файла
+                self._writer = self._open()
+                self._drop_schema()
+            else:
+                self._writer = self._open()
+            self.init_db()
+            self._open_readers()
+
+    def _drop_schema(self) -> None:
+        with self.transaction() as con:
+            # Виртуальные таблицы (FTS5) — первыми: вместе с ними уходят их shadow-таблицы
+            objects = con.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' "
+                "ORDER BY sql LIKE 'CREATE VIRTUAL%' DESC;"
+            ).fetchall()
+            for (name,) in objects:
+                con.execute(f'DROP TABLE IF EXISTS "{name}";')
+            con.execute("PRAGMA user_version=0;")
+
+    def maintenance_tick(self) -> None:
+        """
+        Периодическое обслуживание (раз в ~15 минут из планировщика):
+        PRAGMA optimize — обновляет статистику планировщика по мере роста таблиц,
+        compact() — возвращает часть свободных страниц (auto_vacuum=INCREMENTAL),
+        wal_checkpoint(TRUNCATE) — переносит WAL в основной файл и обнуляет его.
+        Если часть читателей пула занята (например, недочитанным iter_*), TRUNCATE ждал бы их
+        до busy_timeout под локом писателя — тогда только PASSIVE: переносит, что можно, не ожидая.
+        """
+        with self._for_write() as con:
+            con.execute("PRAGMA optimize;")
+            self.compact()
+            if not self._in_memory:
+                readers_busy = self._has_readers and self._readers.qsize() < self._reader_count
+                mode = "PASSIVE" if readers_busy else "TRUNCATE"
+                con.execute(f"PRAGMA wal_checkpoint({mode});").fetchall()
+
+    def compact(self, pages: int = 1000) -> int:
+        """
+        Возвращает до pages свободных страниц файлу (PRAGMA incremental_vacuum), сколько было свободно.
+        Работает только для БД с auto_vacuum=INCREMENTAL (новые БД или после vacuum()), иначе no-op.
+        Внутри transaction() страницы освобождаются в транзакции вызывающего и откатываются вместе с ней.
+        """
+        with self._for_write() as con:
+            freelist = int(con.execute("PRAGMA freelist_count;").fetchone()[0])
+            if not freelist or int(con.execute("PRAGMA auto_vacuum;").fetchone()[0]) != 2:
+                return freelist
+            # Один execute() PRAGMA incremental_vacuum освобождает одну страницу, поэтому цикл, пока
+            # freelist_count падает. Не executescript: он сначала коммитит открытую транзакцию вызывающего
+            own_tx = not con.in_transaction
+            if own_tx:
+                con.execute("BEGIN IMMEDIATE;")
+            try:
+                left = freelist
+                for _ in range(min(int(pages), freelist)):
+                    con.execute("PRAGMA incremental_vacuum(1);")
+                    now = int(con.execute("PRAGMA freelist_count;").fetchone()[0])
+                    if now >= left:
+                        break
+                    left = now
+            except BaseException:
+                if own_tx:
+                    con.execute("ROLLBACK;")
+                raise
+            if own_tx:
+                con.execute("COMMIT;")
+            return freelist
 
     def vacuum(self) -> None:
-        with self._connect() as con:
+        """
+        Полная перепаковка файла. Заодно переводит старую БД в auto_vacuum=INCREMENTAL
+        (режим меняется только вместе с VACUUM) — дальше хватает compact().
+        """
+        with self._for_write() as con:
+            con.execute("PRAGMA auto_vacuum=INCREMENTAL;")
             con.execute("VACUUM;")
 # End of memory_sqlite.py
 # bot/core/secure_tokens.py
\ No newline at end of file
@@ -2,15 +2,16 @@ from __future__ import annotations
 
 import asyncio
 import logging
-import shutil
+import sqlite3
 from datetime import datetime, timedelta
-from zoneinfo import ZoneInfo
+from functools import lru_cache
+from pathlib import Path
 from typing import Any, List
 
 from apscheduler.triggers.cron import CronTrigger
+from telegram.error import RetryAfter
 
 from bot.core.config import (
-    TZ,
     BACKUP_DIR,
     BACKUP_TIME,
     BACKUP_KEEP_DAYS,
@@ -19,6 +20,7 @@ from bot.core.config import (
     INSTANCE_NAME,
 )
 from bot.integrations.google_calendar import GoogleCalendarClient
+from bot.scheduler.utils import LOCAL_TZ, day_hhmm_formatter, run_blocking
 from bot.commands.task_actions import build_task_actions_kb
 
 logger = logging.getLogger(__name__)
@@ -27,12 +29,42 @@ logger = logging.getLogger(__name__)
 # ----------------------- Утилиты -----------------------
 
 
-async def _run_blocking(func, *args, **kwargs):
+async def _send_task_card(app, chat_id: int, task_id: int, text: str, **kwargs) -> None:
     """
-    Запустить блокирующую функцию в thread pool из async-кода.
+    Отправка карточки задачи с кнопками действий. На RetryAfter (429) ждём
+    указанное Telegram время и повторяем один раз.
     """
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, lambda: func(*args, **kwargs))
+    try:
+        await app.bot.send_message(
+            chat_id=chat_id, text=text, reply_markup=build_task_actions_kb(task_id), **kwargs
+        )
+    except RetryAfter as e:
+        await asyncio.sleep(float(e.retry_after))
+        await app.bot.send_message(
+            chat_id=chat_id, text=text, reply_markup=build_task_actions_kb(task_id), **kwargs
+        )
+
+
+async def _send_task_cards(app, chat_id: int, cards, job: str, **kwargs) -> None:
+    """
+    Отправка карточек [(task_id, text), ...] в чат строго по порядку (по времени задач):
+    Telegram показывает сообщения в порядке доставки, поэтому карточки не распараллеливаем.
+    Ошибка одной карточки не прерывает остальные.
+    """
+    for task_id, text in cards:
+        try:
+            await _send_task_card(app, chat_id, task_id, text, **kwargs)
+        except Exception:
+            logger.warning("%s: failed to send task id=%s", job, task_id, exc_info=True)
+
+
+@lru_cache(maxsize=4096)
+def _fmt_local_minute(epoch_min: int) -> str:
+    """
+    "YYYY-MM-DD HH:MM" в зоне LOCAL_TZ по номеру минуты эпохи: задачи обычно стоят на
+    одних и тех же минутах, повторные дайджесты/напоминания берут строку из кэша.
+    """
+    return datetime.fromtimestamp(epoch_min * 60, tz=LOCAL_TZ).strftime("%Y-%m-%d %H:%M")
 
 
 # ----------------------- Напоминания -----------------------
@@ -44,13 +76,12 @@ async def send_task_reminder(app, _mem, user_id: int, task_id: int) -> None:
     Отправляет текст + те же кнопки действий, что и в списках задач.
     """
     try:
-        t = await _run_blocking(_mem.get_task, task_id)
+        t = await run_blocking(_mem.get_task, task_id)
         if not t or not t.due_at:
             return
 
         chat_id = user_id
-        tz = ZoneInfo(TZ)
-        when = datetime.fromtimestamp(t.due_at, tz=tz).strftime("%Y-%m-%d %H:%M")
+        when = _fmt_local_minute(int(t.due_at) // 60)
         suffix = " (весь день)" if (getattr(t, "extra", None) or {}).get("all_day") else ""
         text = f"⏰ Напоминание: {t.text}{suffix}\nВремя: {when}"
 
@@ -72,12 +103,12 @@ async def morning_briefing(app, _mem, user_id: int) -> None:
     08:00 — показать краткий план на сегодня карточками с кнопками действий.
     """
     try:
-        tz = ZoneInfo(TZ)
+        tz = LOCAL_TZ
         now = datetime.now(tz)
         start = now.replace(hour=0, minute=0, second=0, microsecond=0)
         end = start + timedelta(days=1)
 
-        upcoming = await _run_blocking(
+        upcoming = await run_blocking(
             _mem.list_upcoming_tasks,
             user_id=user_id,
             due_from=int(start.timestamp()),
@@ -100,22 +131,14 @@ async def morning_briefing(app, _mem, user_id: int) -> None:
         )
 
         # Карточки по задачам с action-кнопками
-        for t in upcoming:
-            when = (
-                datetime.fromtimestamp(t.due_at, tz=tz).strftime("%H:%M")
-                if t.due_at
-                else "—"
-            )
-            caption = f"🕒 {when} — {t.text}\n[id: {t.id}]"
-            try:
-                await app.bot.send_message(
-                    chat_id=user_id,
-                    text=caption,
-                    reply_markup=build_task_actions_kb(t.id),
-                    disable_web_page_preview=True,
-                )
-            except Exception:
-                logger.warning("morning_briefing: failed to send task id=%s", t.id, exc_info=True)
+        hhmm = day_hhmm_formatter(tz, start, end)
+        await _send_task_cards(
+            app,
+            user_id,
+            ((t.id, f"🕒 {hhmm(t.due_at) if t.due_at else '—'} — {t.text}\n[id: {t.id}]") for t in upcoming),
+            "morning_briefing",
+            disable_web_page_preview=True,
+        )
 
     except Exception:
         logger.exception("morning_briefing failed")
@@ -130,12 +153,12 @@ async def send_daily_digest(app, _mem, user_id: int) -> None:
     Вечерний дайджест задач на завтра (карточками с кнопками действий).
     """
     try:
-        tz = ZoneInfo(TZ)
+        tz = LOCAL_TZ
         now = datetime.now(tz)
         start = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
         end = start + timedelta(days=1)
 
-        upcoming = await _run_blocking(
+        upcoming = await run_blocking(
             _mem.list_upcoming_tasks,
             user_id=user_id,
             due_from=int(start.timestamp()),
@@ -153,22 +176,14 @@ async def send_daily_digest(app, _mem, user_id: int) -> None:
             text=f"🗓 План на завтра ({date_label}) — {len(upcoming)} задач(и):",
         )
 
-        for t in upcoming:
-            when = (
-                datetime.fromtimestamp(t.due_at, tz=tz).strftime("%H:%M")
-                if t.due_at
-                else "—"
-            )
-            caption = f"🕒 {when} — {t.text}\n[id: {t.id}]"
-            try:
-                await app.bot.send_message(
-                    chat_id=user_id,
-                    text=caption,
-                    reply_markup=build_task_actions_kb(t.id),
-                    disable_web_page_preview=True,
-                )
-            except Exception:
-                logger.warning("send_daily_digest: failed to send task id=%s", t.id, exc_info=True)
+        hhmm = day_hhmm_formatter(tz, start, end)
+        await _send_task_cards(
+            app,
+            user_id,
+            ((t.id, f"🕒 {hhmm(t.due_at) if t.due_at else '—'} — {t.text}\n[id: {t.id}]") for t in upcoming),
+            "send_daily_digest",
+            disable_web_page_preview=True,
+        )
 
     except Exception:
         logger.exception("send_daily_digest failed")
@@ -183,10 +198,10 @@ async def send_overdue_digest(app, _mem, user_id: int) -> None:
     Вечерний дайджест просроченных задач.
     """
     try:
-        tz = ZoneInfo(TZ)
+        tz = LOCAL_TZ
         now_epoch = int(datetime.now(tz).timestamp())
 
-        items = await _run_blocking(
+        items = await run_blocking(
             _mem.list_upcoming_tasks,
             user_id=user_id,
             due_from=0,
@@ -199,18 +214,11 @@ async def send_overdue_digest(app, _mem, user_id: int) -> None:
 
         await app.bot.send_message(chat_id=user_id, text="⚠️ Просроченные задачи:")
 
+        cards = []
         for t in items:
-            when = (
-                datetime.fromtimestamp(t.due_at, tz=tz).strftime("%Y-%m-%d %H:%M")
-                if t.due_at
-                else "—"
-            )
-            text = f"• [{t.id}] {t.text}\n⏳ Срок был: {when}"
-            kb = build_task_actions_kb(t.id)
-            try:
-                await app.bot.send_message(chat_id=user_id, text=text, reply_markup=kb)
-            except Exception:
-                logger.warning("send_overdue_digest: item send failed", exc_info=True)
+            when = _fmt_local_minute(int(t.due_at) // 60) if t.due_at else "—"
+            cards.append((t.id, f"• [{t.id}] {t.text}\n⏳ Срок был: {when}"))
+        await _send_task_cards(app, user_id, cards, "send_overdue_digest")
     except Exception:
         logger.exception("send_overdue_digest failed")
 
@@ -227,13 +235,17 @@ async def run_google_pull_and_schedule(app, _mem, user_id: int, scheduler) -> No
         if not gc.is_connected(user_id):
             return
 
-        tz = ZoneInfo(TZ)
-        res = await _run_blocking(gc.sync_pull, user_id)
-        affected_ids = list(set(res.get("imported", []) + res.get("updated", [])))
+        tz = LOCAL_TZ
+        res = await run_blocking(gc.sync_pull, user_id)
+        # Дедупликация с сохранением порядка: напоминания ставятся детерминированно
+        affected_ids = list(dict.fromkeys((*res.get("imported", ()), *res.get("updated", ()))))
         now = datetime.now(tz).timestamp()
 
+        # Один IN-запрос вместо get_task на каждый id
+        tasks = await run_blocking(_mem.get_tasks_by_ids, affected_ids) if affected_ids else {}
+
         for task_id in affected_ids:
-            t = await _run_blocking(_mem.get_task, task_id)
+            t = tasks.get(int(task_id))
             if not t or not t.due_at:
                 continue
             if (getattr(t, "extra", None) or {}).get("all_day"):
@@ -279,6 +291,22 @@ async def health_ping(app, _mem, user_id: int, scheduler) -> None:
         logger.warning("health_ping failed", exc_info=True)
 
 
+# ----------------------- Обслуживание SQLite -----------------------
+
+
+async def sqlite_maintenance(_mem) -> None:
+    """
+    Каждые 15 минут: PRAGMA optimize + wal_checkpoint(TRUNCATE) (для SQLite-бэкенда).
+    """
+    tick = getattr(_mem, "maintenance_tick", None)
+    if tick is None:
+        return
+    try:
+        await run_blocking(tick)
+    except Exception:
+        logger.warning("sqlite_maintenance failed", exc_info=True)
+
+
 # ----------------------- Бэкап SQLite -----------------------
 
 
@@ -286,45 +314,95 @@ def _timestamp() -> str:
     return datetime.now().strftime("%Y%m%d-%H%M%S")
 
 
+# Текущий формат — .tar.zst; старые .zip-архивы тоже ротируются, пока не истекут
+_BACKUP_SUFFIXES = (".tar.zst", ".zip")
+
+
 def _rotate_old_backups(prefix: str, keep_days: int) -> None:
     try:
         import os
         import time
-        import glob
 
         cutoff = time.time() - keep_days * 86400
-        for path in glob.glob(str(BACKUP_DIR / f"{prefix}-*.zip")):
-            if os.path.getmtime(path) < cutoff:
-                os.remove(path)
+        head = f"{prefix}-"
+        # scandir: имя фильтруем в Python, stat — один вызов на запись каталога
+        with os.scandir(BACKUP_DIR) as entries:
+            for e in entries:
+                if (
+                    e.name.startswith(head)
+                    and e.name.endswith(_BACKUP_SUFFIXES)
+                    and e.is_file(follow_symlinks=False)
+                    and e.stat(follow_symlinks=False).st_mtime < cutoff
+                ):
+                    os.remove(e.path)
     except Exception:
         logger.warning("rotate backups failed", exc_info=True)
 
 
-async def sqlite_backup_job() -> None:
+def _snapshot_sqlite(src) -> bytes:
     """
-    Ночной бэкап app.sqlite3 + jobs.sqlite3 в ZIP.
+    Консистентный снимок живой БД через online backup API SQLite (с учётом ещё не
+    checkpoint'нутых страниц WAL), в отличие от копирования файла. Источник открываем
+    только на чтение; копирование одним шагом — одна читающая транзакция, писателей не блокирует.
+    Снимок собирается в :memory: и отдаётся байтами — без временного файла на диске.
     """
+    src_con = sqlite3.connect(f"{Path(src).resolve().as_uri()}?mode=ro", uri=True)
     try:
-        import zipfile
+        mem_con = sqlite3.connect(":memory:")
+        try:
+            src_con.backup(mem_con)
+            return mem_con.serialize()
+        finally:
+            mem_con.close()
+    finally:
+        src_con.close()
+
+
+def _write_backup_archive(out: Path, members: List[tuple[str, bytes]]) -> None:
+    """
+    tar-поток сразу в zstd-компрессор (многопоточный, threads=-1) — без промежуточных файлов.
+    """
+    import io
+    import tarfile
+    import time
+    import zstandard
 
+    cctx = zstandard.ZstdCompressor(level=3, threads=-1)
+    with open(out, "wb") as f, cctx.stream_writer(f) as zw:
+        with tarfile.open(fileobj=zw, mode="w|") as tar:
+            for name, data in members:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = int(time.time())
+                tar.addfile(info, io.BytesIO(data))
+
+
+async def sqlite_backup_job() -> None:
+    """
+    Ночной бэкап app.sqlite3 + jobs.sqlite3 в tar.zst.
+    """
+    try:
         stamp = _timestamp()
-        out = BACKUP_DIR / f"{INSTANCE_NAME}-{stamp}.zip"
-        with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-            for src, name in [
-                (DB_PATH, "app.sqlite3"),
-                (JOBSTORE_DB_PATH, "jobs.sqlite3"),
-            ]:
-                try:
-                    tmp = BACKUP_DIR / f"_tmp_{stamp}_{name}"
-                    shutil.copy2(src, tmp)
-                    zf.write(tmp, arcname=name)
-                    tmp.unlink(missing_ok=True)
-                except Exception:
-                    logger.warning(
-                        "backup copy failed: %s", name, exc_info=True
-                    )
-
-        _rotate_old_backups(INSTANCE_NAME, BACKUP_KEEP_DAYS)
+        out = BACKUP_DIR / f"{INSTANCE_NAME}-{stamp}.tar.zst"
+        members: List[tuple[str, bytes]] = []
+        for src, name in [
+            (DB_PATH, "app.sqlite3"),
+            (JOBSTORE_DB_PATH, "jobs.sqlite3"),
+        ]:
+            try:
+                members.append((name, await run_blocking(_snapshot_sqlite, src)))
+            except Exception:
+                logger.warning(
+                    "backup copy failed: %s", name, exc_info=True
+                )
+
+        if not members:
+            # Пустой архив — не бэкап; и ротацию не запускаем, чтобы не удалить старые рабочие копии
+            logger.error("sqlite_backup_job: no database snapshots, backup skipped")
+            return
+
+        await run_blocking(_write_backup_archive, out, members)
+        await run_blocking(_rotate_old_backups, INSTANCE_NAME, BACKUP_KEEP_DAYS)
         logger.info("💾 Backup created: %s", out)
     except Exception:
         logger.exception("sqlite_backup_job failed")
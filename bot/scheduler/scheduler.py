@@ -1,15 +1,14 @@
 from __future__ import annotations
 
 import logging
+from datetime import datetime, timedelta
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.triggers.interval import IntervalTrigger
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
-from zoneinfo import ZoneInfo
 
 from bot.core.config import (
-    TZ,
     SYNC_INTERVAL_MINUTES,
     JOBSTORE_DB_PATH,
     BACKUP_ENABLED,
@@ -21,8 +20,10 @@ from .jobs import (
     send_overdue_digest,
     morning_briefing,
     health_ping,
+    sqlite_maintenance,
     schedule_sqlite_backup_job,
 )
+from .utils import LOCAL_TZ, day_hhmm_formatter, run_blocking
 from bot.gpt.client import ask_gpt
 
 logger = logging.getLogger(__name__)
@@ -38,7 +39,7 @@ def get_scheduler() -> AsyncIOScheduler:
     """
     global _scheduler
     if _scheduler is None:
-        _scheduler = AsyncIOScheduler(timezone=ZoneInfo(TZ))
+        _scheduler = AsyncIOScheduler(timezone=LOCAL_TZ)
     return _scheduler
 
 
@@ -47,8 +48,19 @@ async def build_gpt_tomorrow_summary(mem, user_id: int) -> str:
     """
     Краткая GPT-сводка по приоритетам на завтра.
     """
+    tz = LOCAL_TZ
+    start = datetime.now(tz).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    end = start + timedelta(days=1)
     try:
-        tasks = mem.list_tasks(user_id=user_id, status="open", limit=50, offset=0)
+        # Только задачи на завтра — диапазон due_at по индексу, а не все открытые задачи
+        tasks = await run_blocking(
+            mem.list_upcoming_tasks,
+            user_id=user_id,
+            due_from=int(start.timestamp()),
+            due_to=int(end.timestamp()),
+            status="open",
+            limit=20,
+        )
     except Exception as e:
         logger.exception("GPT summary: DB error: %s", e)
         return "⚠️ Ошибка при получении задач."
@@ -56,7 +68,8 @@ async def build_gpt_tomorrow_summary(mem, user_id: int) -> str:
     if not tasks:
         return "На завтра открытых задач нет."
 
-    lines = [f"- {t.text} | срок: {getattr(t, 'due_at', '—')}" for t in tasks]
+    hhmm = day_hhmm_formatter(tz, start, end)
+    lines = [f"- {t.text} | срок: {hhmm(t.due_at)}" for t in tasks]
     messages = [
         {
             "role": "system",
@@ -100,6 +113,7 @@ def start_scheduler(app, _mem, owner_user_id: int) -> AsyncIOScheduler:
       - Вечерний дайджест просроченных (20:00)
       - Вечерний дайджест + GPT-сводка (21:00)
       - Health ping каждый час
+      - Обслуживание SQLite каждые 15 минут
       - Ночной бэкап SQLite-БД (если включен)
     """
     sched = get_scheduler()
@@ -159,6 +173,17 @@ def start_scheduler(app, _mem, owner_user_id: int) -> AsyncIOScheduler:
         max_instances=1,
     )
 
+    # --- Обслуживание SQLite: optimize + checkpoint WAL ---
+    sched.add_job(
+        sqlite_maintenance,
+        trigger=IntervalTrigger(minutes=15),
+        args=[_mem],
+        id="sqlite_maintenance",
+        replace_existing=True,
+        coalesce=True,
+        max_instances=1,
+    )
+
     # --- Ночной бэкап SQLite (если включён) ---
     if BACKUP_ENABLED:
         schedule_sqlite_backup_job(sched)
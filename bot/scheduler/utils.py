@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from zoneinfo import ZoneInfo
+
+from bot.core.config import TZ
+
+# Зона TZ из конфига не меняется в рантайме — один объект на процесс
+LOCAL_TZ = ZoneInfo(TZ)
+
+# Собственный небольшой пул для джобов: всплеск дайджестов не конкурирует за дефолтный
+# executor с остальным asyncio-кодом, а к SQLite одновременно идёт не больше 4 потоков
+_BLOCKING_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="memio")
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Запустить блокирующую функцию в thread pool планировщика из async-кода.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_BLOCKING_EXECUTOR, partial(func, *args, **kwargs))
+
+
+def day_hhmm_formatter(tz: ZoneInfo, start: datetime, end: datetime):
+    """
+    Форматтер "HH:MM" для моментов внутри суток [start, end].
+    Если за эти сутки смещение зоны не меняется (нет перехода DST), время считается
+    арифметикой от одного смещения — без datetime на каждую задачу.
+    """
+    offset = start.utcoffset()
+    if offset is None or offset != end.utcoffset():
+        return lambda ts: datetime.fromtimestamp(ts, tz=tz).strftime("%H:%M")
+    offset_s = int(offset.total_seconds())
+
+    def fmt(ts: int) -> str:
+        minutes = (int(ts) + offset_s) // 60
+        return f"{minutes // 60 % 24:02d}:{minutes % 60:02d}"
+
+    return fmt
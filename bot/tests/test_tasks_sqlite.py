@@ -20,7 +20,7 @@ def mem():
     memory = MemorySQLite(db_path=DB_PATH)
     yield memory
     # Закрываем соединения и удаляем тестовую базу
-    del memory
+    memory.close()
     if DB_PATH.exists():
         try:
             DB_PATH.unlink()
@@ -28,6 +28,13 @@ def mem():
             # В Windows иногда файл ещё используется, можно игнорировать
             pass
 
+@pytest.fixture
+def file_memory(tmp_path):
+    """Файловая БД: в отличие от :memory:, чтения идут через пул read-only соединений."""
+    memory = MemorySQLite(db_path=tmp_path / "app.sqlite3")
+    yield memory
+    memory.close()
+
 def test_tasks_add_and_migrate_due_at(mem: MemorySQLite):
     """Полная проверка задач: старые задачи без due_at, добавление новой задачи с due_at."""
 
@@ -77,3 +84,410 @@ def test_tasks_add_and_migrate_due_at(mem: MemorySQLite):
     assert task.user_id == 10
     assert isinstance(task.created_at, int)
     assert task.due_at == due_ts
+
+
+def test_in_memory_db_keeps_data_between_calls():
+    """:memory: — одно долгоживущее соединение, данные не теряются между вызовами."""
+    memory = MemorySQLite(":memory:")
+    task_id = memory.add_task(user_id=1, text="Задача в памяти")
+    task = memory.get_task(task_id)
+    assert task is not None
+    assert task.text == "Задача в памяти"
+    assert [t.id for t in memory.list_tasks(user_id=1)] == [task_id]
+
+
+def test_update_task_keeps_due_at_unless_passed():
+    """update_task без due_at не трогает срок; due_at=None — явно снимает его."""
+    memory = MemorySQLite(":memory:")
+    due_ts = int(time.time()) + 3600
+    task_id = memory.add_task(user_id=1, text="Со сроком", due_at=due_ts)
+
+    assert memory.update_task(task_id, status="done")
+    assert memory.get_task(task_id).due_at == due_ts
+
+    assert memory.update_task(task_id, due_at=None)
+    assert memory.get_task(task_id).due_at is None
+
+
+def test_update_task_clears_nullable_fields_only_when_passed():
+    """notes/recurrence/extra: не переданы — остаются; None — очищаются."""
+    memory = MemorySQLite(":memory:")
+    task_id = memory.add_task(1, "Поля", notes="заметка", recurrence="RRULE:FREQ=DAILY", extra={"a": 1})
+
+    memory.update_task(task_id, text="Поля 2")
+    task = memory.get_task(task_id)
+    assert (task.notes, task.recurrence, task.extra) == ("заметка", "RRULE:FREQ=DAILY", {"a": 1})
+
+    memory.update_task(task_id, notes=None, recurrence=None, extra=None)
+    task = memory.get_task(task_id)
+    assert (task.notes, task.recurrence, task.extra) == (None, None, None)
+
+
+def test_iter_tasks_streams_same_rows_as_list_tasks():
+    """iter_tasks отдаёт те же задачи и в том же порядке, что и list_tasks."""
+    memory = MemorySQLite(":memory:")
+    now = int(time.time())
+    memory.add_task(user_id=1, text="Без срока")
+    memory.add_task(user_id=1, text="Позже", due_at=now + 7200)
+    memory.add_task(user_id=1, text="Раньше", due_at=now + 3600)
+
+    it = memory.iter_tasks(user_id=1)
+    assert next(it).text == "Раньше"
+    it.close()
+
+    assert [t.id for t in memory.iter_tasks(user_id=1)] == [t.id for t in memory.list_tasks(user_id=1)]
+    assert [t.text for t in memory.list_tasks(user_id=1)] == ["Раньше", "Позже", "Без срока"]
+
+
+def test_upsert_task_inserts_then_updates_in_place():
+    """upsert_task: без id — новая задача, с существующим id — обновление той же строки."""
+    memory = MemorySQLite(":memory:")
+    task_id = memory.upsert_task(None, 1, "Черновик")
+    created_at = memory.get_task(task_id).created_at
+
+    assert memory.upsert_task(task_id, 1, "Итог", status="done") == task_id
+    task = memory.get_task(task_id)
+    assert (task.text, task.status, task.created_at) == ("Итог", "done", created_at)
+    assert len(memory.list_tasks(user_id=1)) == 1
+
+
+def test_add_tasks_bulk_returns_ids_and_transaction_rolls_back():
+    """add_tasks_bulk: id в порядке rows; transaction(): при исключении ничего не сохраняется."""
+    memory = MemorySQLite(":memory:")
+    memory.add_task(1, "Раньше")
+    ids = memory.add_tasks_bulk([{"user_id": 1, "text": f"Импорт {i}", "due_at": 100 + i} for i in range(3)])
+    assert [memory.get_task(i).text for i in ids] == ["Импорт 0", "Импорт 1", "Импорт 2"]
+
+    with pytest.raises(RuntimeError):
+        with memory.transaction():
+            memory.add_task(1, "Откатится")
+            raise RuntimeError
+    assert len(memory.list_tasks(user_id=1)) == 4
+
+
+def test_slim_task_queries_return_only_requested_columns():
+    """list_task_ids_due_between / iter_task_columns: узкие выборки без сборки Task."""
+    memory = MemorySQLite(":memory:")
+    early = memory.add_task(1, "Рано", due_at=100)
+    late = memory.add_task(1, "Поздно", due_at=200)
+    memory.add_task(1, "Без срока")
+
+    assert memory.list_task_ids_due_between(50, 150, user_id=1) == [early]
+    rows = list(memory.iter_task_columns(("id", "due_at"), user_id=1))
+    assert [(r["id"], r["due_at"]) for r in rows[:2]] == [(early, 100), (late, 200)]
+    with pytest.raises(ValueError):
+        list(memory.iter_task_columns(("id; DROP TABLE tasks",)))
+
+
+def test_task_extra_is_decoded_lazily(monkeypatch):
+    """Task.extra: из БД приходит сырой JSON, декодируется один раз — при первом обращении."""
+    from bot.memory import memory_sqlite
+
+    memory = MemorySQLite(":memory:")
+    task_id = memory.add_task(1, "С extra", extra={"gcal": {"id": "e1"}})
+    decoded = []
+    json_loads = memory_sqlite._json_loads
+    monkeypatch.setattr(memory_sqlite, "_json_loads", lambda blob: decoded.append(blob) or json_loads(blob))
+
+    task = memory.get_task(task_id)
+    assert decoded == []
+    assert task.extra == {"gcal": {"id": "e1"}}
+    assert task.extra is task.extra
+    assert len(decoded) == 1
+
+
+def test_update_task_returning_gives_fresh_task():
+    """update_task_returning: новое состояние задачи из RETURNING; неизвестный id — None."""
+    memory = MemorySQLite(":memory:")
+    task_id = memory.add_task(1, "Старый текст", extra={"k": 1})
+    task = memory.update_task_returning(task_id, text="Новый текст", status="done")
+    assert (task.id, task.text, task.status, task.extra) == (task_id, "Новый текст", "done", {"k": 1})
+    assert memory.update_task_returning(task_id + 100, text="нет") is None
+
+
+def test_add_task_returning_gives_created_task():
+    """add_task_returning: созданная задача из INSERT ... RETURNING совпадает с get_task."""
+    memory = MemorySQLite(":memory:")
+    task = memory.add_task_returning(1, "Купить хлеб", due_at=1_700_000_000, extra={"k": 1})
+    assert task == memory.get_task(task.id)
+    assert (task.status, task.due_at, task.extra) == ("open", 1_700_000_000, {"k": 1})
+
+
+def test_list_tasks_offset_without_limit():
+    """offset без limit: LIMIT/OFFSET — параметры, LIMIT -1 означает «без ограничения»."""
+    memory = MemorySQLite(":memory:")
+    for i in range(4):
+        memory.add_task(1, f"Задача {i}", due_at=100 + i)
+    assert [t.text for t in memory.list_tasks(user_id=1, offset=2)] == ["Задача 2", "Задача 3"]
+
+
+def test_upsert_task_by_calendar_event_inserts_once_and_respects_etag():
+    """Синк события: одна задача на событие; тот же etag — без перезаписи, новый — обновление."""
+    memory = MemorySQLite(":memory:")
+    task_id = memory.upsert_task_by_calendar_event(1, "primary", "ev1", "Встреча", event_etag="v1")
+    assert memory.upsert_task_by_calendar_event(1, "primary", "ev1", "Игнор", event_etag="v1") == task_id
+    assert memory.get_task(task_id).text == "Встреча"
+
+    assert memory.upsert_task_by_calendar_event(1, "primary", "ev1", "Перенесена", event_etag="v2") == task_id
+    task = memory.get_task(task_id)
+    assert (task.text, task.calendar_event_etag) == ("Перенесена", "v2")
+    assert len(memory.list_tasks(user_id=1)) == 1
+
+
+def test_oauth_token_cache_is_invalidated_on_write(monkeypatch):
+    """get_oauth_token кэшируется; upsert/delete сбрасывают кэш, копия наружу (и вложенные списки) не портит кэш."""
+    from cryptography.fernet import Fernet
+    from bot.core import secure_tokens
+
+    monkeypatch.setenv("ENCRYPTION_KEY", Fernet.generate_key().decode())
+    monkeypatch.setattr(secure_tokens, "_FERNET", None)
+    memory = MemorySQLite(":memory:")
+    memory.upsert_oauth_token("1", "google_calendar", {"token": "a", "scopes": ["cal"]})
+
+    first = memory.get_oauth_token("1", "google_calendar")
+    first.token_json["token"] = "испорчен"
+    first.token_json["scopes"].append("испорчен")
+    assert memory.get_oauth_token("1", "google_calendar").token_json == {"token": "a", "scopes": ["cal"]}
+
+    memory.upsert_oauth_token("1", "google_calendar", {"token": "b"})
+    assert memory.get_oauth_token("1", "google_calendar").token_json == {"token": "b"}
+    assert memory.delete_oauth_token("1", "google_calendar")
+    assert memory.get_oauth_token("1", "google_calendar") is None
+
+
+def test_upsert_oauth_token_skips_unchanged(monkeypatch):
+    """Тот же токен повторно — без шифрования и записи; skip_if_same=False перезаписывает."""
+    from cryptography.fernet import Fernet
+    from bot.core import secure_tokens
+    from bot.memory import memory_sqlite
+
+    monkeypatch.setenv("ENCRYPTION_KEY", Fernet.generate_key().decode())
+    monkeypatch.setattr(secure_tokens, "_FERNET", None)
+    calls = []
+    monkeypatch.setattr(memory_sqlite, "encrypt_dict", lambda d: calls.append(d) or secure_tokens.encrypt_dict(d))
+    memory = MemorySQLite(":memory:")
+    memory.upsert_oauth_token("1", "google_calendar", {"token": "a"}, expiry=100, scopes=["cal"])
+    memory.upsert_oauth_token("1", "google_calendar", {"token": "a"}, expiry=100, scopes=["cal"])
+    assert len(calls) == 1
+    memory.upsert_oauth_token("1", "google_calendar", {"token": "a"}, expiry=100, scopes=["cal"], skip_if_same=False)
+    memory.upsert_oauth_token("1", "google_calendar", {"token": "a"}, expiry=200, scopes=["cal"])
+    assert len(calls) == 3
+    assert memory.get_oauth_token("1", "google_calendar").expiry == 200
+
+
+def test_add_conversation_messages_bulk():
+    """Пачка сообщений диалога: id по порядку, сообщения читаются обратно."""
+    memory = MemorySQLite(":memory:")
+    ids = memory.add_conversation_messages_bulk([
+        {"user_id": 7, "role": "user", "content": "Привет", "ts_epoch": 100},
+        {"user_id": 7, "role": "assistant", "content": "Здравствуйте", "ts_epoch": 101, "meta_json": {"m": 1}},
+    ])
+    assert len(ids) == 2 and ids[1] == ids[0] + 1
+    messages = memory.list_conversation_messages(7)
+    assert sorted((m.content, m.meta_json) for m in messages) == [("Здравствуйте", {"m": 1}), ("Привет", None)]
+
+
+def test_update_task_skips_unchanged_fields(monkeypatch):
+    """Повторная запись тех же значений не сдвигает updated_at/last_modified; реальная — сдвигает."""
+    clock = [1_000]
+    monkeypatch.setattr(time, "time_ns", lambda: clock[0] * 1_000_000_000)
+    memory = MemorySQLite(":memory:")
+    task_id = memory.add_task(1, "Синк", extra={"gcal": {"id": "e1"}})
+
+    clock[0] = 2_000
+    assert memory.update_task(task_id, text="Синк", extra={"gcal": {"id": "e1"}})
+    task = memory.get_task(task_id)
+    assert (task.updated_at, task.last_modified) == (1_000, 1_000)
+
+    assert memory.update_task(task_id, text="Синк 2", extra={"gcal": {"id": "e1"}})
+    task = memory.get_task(task_id)
+    assert task.text == "Синк 2" and (task.updated_at, task.last_modified) == (2_000, 2_000)
+    assert not memory.update_task(task_id + 100, text="нет")
+
+
+def test_search_conversation_messages_uses_fts_index():
+    """Поиск по истории: слова — префиксы, сначала новые; индекс следит за вставкой/удалением, чужие сообщения не попадают."""
+    memory = MemorySQLite(":memory:")
+    memory.add_conversation_message(1, "user", "Напомни купить молоко", ts_epoch=1)
+    memory.add_conversation_message(1, "assistant", "Хорошо, напомню про хлеб", ts_epoch=2)
+    memory.add_conversation_message(2, "user", "купить молоко", ts_epoch=3)
+    assert [m.content for m in memory.search_conversation_messages(1, "молоко купить")] == ["Напомни купить молоко"]
+    assert [m.content for m in memory.search_conversation_messages(1, "НАПОМ")] == [
+        "Хорошо, напомню про хлеб",
+        "Напомни купить молоко",
+    ]
+    assert memory.search_conversation_messages(1, "оло") == []
+
+    memory.delete_conversation_history(1)
+    assert memory.search_conversation_messages(1, "молоко") == []
+
+
+def test_compact_returns_free_pages():
+    """Новая БД создаётся с auto_vacuum=INCREMENTAL: compact() отдаёт страницы, освобождённые удалением."""
+    memory = MemorySQLite(":memory:")
+    memory.add_tasks_bulk([{"user_id": 1, "text": "x" * 500} for _ in range(500)])
+    for task in memory.list_tasks(1):
+        memory.delete_task(task.id)
+    assert memory.compact() > 0
+    assert memory.compact() == 0
+
+
+def test_compact_inside_transaction_keeps_caller_transaction(file_memory: MemorySQLite):
+    """compact() внутри transaction() не коммитит чужие записи: откат блока убирает и их."""
+    file_memory.add_tasks_bulk([{"user_id": 1, "text": "x" * 500} for _ in range(500)])
+    for task in file_memory.list_tasks(1):
+        file_memory.delete_task(task.id)
+
+    with pytest.raises(RuntimeError):
+        with file_memory.transaction():
+            file_memory.add_task(1, "Откатится")
+            assert file_memory.compact() > 0
+            raise RuntimeError
+    assert file_memory.list_tasks(1) == []
+    assert file_memory.compact() > 0
+    assert file_memory.compact() == 0
+
+
+def test_list_tasks_by_extra_field_filters_in_sqlite():
+    """Фильтр по полю extra: json_extract в SQL, задачи без extra и других пользователей не попадают."""
+    memory = MemorySQLite(":memory:")
+    hit = memory.add_task(1, "Из голосового", extra={"source_kind": "voice", "n": 2})
+    memory.add_task(1, "Из текста", extra={"source_kind": "text"})
+    memory.add_task(1, "Без extra")
+    memory.add_task(2, "Чужая", extra={"source_kind": "voice"})
+    assert [t.id for t in memory.list_tasks_by_extra_field("source_kind", "voice", user_id=1)] == [hit]
+    assert [t.id for t in memory.list_tasks_by_extra_field("n", 2)] == [hit]
+
+
+def test_prune_conversation_history_keeps_last_messages():
+    """prune одним DELETE: остаются keep_last последних сообщений; если их меньше — ничего не удаляется."""
+    memory = MemorySQLite(":memory:")
+    memory.add_conversation_messages_bulk(
+        [{"user_id": 1, "role": "user", "content": f"m{i}", "ts_epoch": 100 + i} for i in range(5)]
+    )
+    assert memory.prune_conversation_history(1, keep_last=10) == 0
+    assert memory.prune_conversation_history(1, keep_last=2) == 3
+    assert [m.content for m in memory.list_conversation_messages(1)] == ["m3", "m4"]
+
+
+def test_get_tasks_by_ids_batches_lookup():
+    """Пакетный get_task: карта {id: Task}, дубликаты и отсутствующие id не мешают, пачки больше лимита параметров."""
+    memory = MemorySQLite(":memory:")
+    ids = memory.add_tasks_bulk([{"user_id": 1, "text": f"t{i}"} for i in range(1000)])
+    found = memory.get_tasks_by_ids(ids + [ids[0], 10**9])
+    assert len(found) == 1000
+    assert found[ids[-1]].text == "t999"
+    assert memory.get_tasks_by_ids([]) == {}
+
+
+def test_deleted_task_id_is_never_reused(tmp_path):
+    """id удалённой (последней) задачи не выдаётся снова — в т.ч. после пересборки таблицы схемы v14."""
+    memory = MemorySQLite(":memory:")
+    memory.add_task(1, "Первая")
+    last = memory.add_task(1, "Удалим")
+    memory.delete_task(last)
+    assert memory.add_task(1, "Новая") > last
+
+    db = tmp_path / "v14.db"
+    con = sqlite3.connect(db)
+    con.execute(
+        "CREATE TABLE tasks (id INTEGER PRIMARY KEY NOT NULL, user_id INTEGER NOT NULL, text TEXT NOT NULL, "
+        "raw_text TEXT, status TEXT NOT NULL DEFAULT 'open', due_at INTEGER, created_at INTEGER NOT NULL, "
+        "updated_at INTEGER NOT NULL, source TEXT, source_agent TEXT, extra TEXT, calendar_id TEXT, "
+        "calendar_event_id TEXT, calendar_event_etag TEXT, google_updated_at INTEGER, recurrence TEXT, "
+        "person_id INTEGER, notes TEXT, last_modified INTEGER);"
+    )
+    con.execute("INSERT INTO tasks (id, user_id, text, created_at, updated_at) VALUES (5, 1, 'Старая', 1, 1);")
+    con.execute("PRAGMA user_version=14;")
+    con.commit()
+    con.close()
+
+    memory = MemorySQLite(db)
+    try:
+        assert memory.get_task(5).text == "Старая"
+        memory.delete_task(5)
+        assert memory.add_task(1, "После апгрейда") == 6
+    finally:
+        memory.close()
+
+
+def test_list_upcoming_tasks_overdue_window_from_zero():
+    """due_from=0 — окно «всё просроченное» (send_overdue_digest), а не «с текущего момента»."""
+    memory = MemorySQLite(":memory:")
+    now = int(time.time())
+    overdue = memory.add_task(1, "Просрочена", due_at=now - 3600)
+    memory.add_task(1, "Впереди", due_at=now + 3600)
+    assert [t.id for t in memory.list_upcoming_tasks(user_id=1, due_from=0, due_to=now - 1)] == [overdue]
+    assert [t.text for t in memory.list_upcoming_tasks(user_id=1)] == ["Впереди"]
+
+
+def test_reads_inside_transaction_see_own_writes(file_memory: MemorySQLite):
+    """Файловая БД: внутри transaction() чтения видят свои незакоммиченные записи, пул — только после COMMIT."""
+    with file_memory.transaction():
+        task_id = file_memory.add_task(1, "В транзакции")
+        assert file_memory.get_task(task_id).text == "В транзакции"
+        assert [t.id for t in file_memory.list_tasks(user_id=1)] == [task_id]
+    assert file_memory.get_task(task_id).text == "В транзакции"
+
+
+def test_suspended_iterators_do_not_block_writers_or_hang_readers(tmp_path, monkeypatch):
+    """Приостановленный iter_*: на :memory: не держит лок писателя; на файле занятый пул — ошибка по таймауту."""
+    import threading
+    from bot.memory import memory_sqlite
+
+    memory = MemorySQLite(":memory:")
+    memory.add_task(1, "Первая")
+    memory.add_task(1, "Вторая")
+    rows = memory.iter_tasks(1)
+    next(rows)
+    writer = threading.Thread(target=memory.add_task, args=(1, "Из другого потока"))
+    writer.start()
+    writer.join(timeout=5)
+    assert not writer.is_alive()
+    rows.close()
+
+    monkeypatch.setattr(memory_sqlite, "READER_ACQUIRE_TIMEOUT", 0.05)
+    memory = MemorySQLite(tmp_path / "pool.sqlite3", readers=1)
+    try:
+        memory.add_task(1, "Задача")
+        rows = memory.iter_tasks(1)
+        next(rows)
+        with pytest.raises(sqlite3.OperationalError):
+            memory.get_task(1)
+        rows.close()
+        assert memory.get_task(1).text == "Задача"
+        memory.maintenance_tick()
+    finally:
+        memory.close()
+
+
+def test_reset_db_with_busy_reader(file_memory: MemorySQLite, monkeypatch):
+    """reset_db при недочитанном iter_*: старый читатель не возвращается в пул; без удаления файла (Windows) — DROP."""
+    for i in range(3):
+        file_memory.add_task(1, f"Старая {i}")
+    rows = file_memory.iter_tasks(1)
+    next(rows)
+    file_memory.reset_db()
+    file_memory.add_task(1, "Новая")
+    rows.close()
+    assert [len(file_memory.list_tasks(1)) for _ in range(8)] == [1] * 8
+
+    def locked(self, missing_ok=False):
+        raise PermissionError(self)
+
+    monkeypatch.setattr(Path, "unlink", locked)
+    file_memory.reset_db()
+    assert file_memory.list_tasks(1) == []
+    assert file_memory.get_task(file_memory.add_task(1, "После DROP")).text == "После DROP"
+
+
+def test_json_fields_do_not_need_global_dict_adapter():
+    """extra/meta_json кодируются явно: sqlite3 в процессе не получает адаптер dict, подклассы dict пишутся."""
+    from collections import OrderedDict
+
+    memory = MemorySQLite(":memory:")
+    with pytest.raises(sqlite3.ProgrammingError):
+        sqlite3.connect(":memory:").execute("SELECT ?;", ({"k": 1},))
+    task_id = memory.add_task(1, "С подклассом dict", extra=OrderedDict(k=1))
+    memory.update_task(task_id, extra={"k": 2})
+    assert memory.get_task(task_id).extra == {"k": 2}